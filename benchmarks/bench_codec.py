@@ -0,0 +1,33 @@
+''' Payload size and encode/decode speed of each codec vs json
+    Run from repo root: python3 -m benchmarks.bench_codec '''
+import timeit
+from package.codec import CODECS, Schema
+
+PAYLOADS = {
+    'ina219': {'Vbusf': 5.12, 'IbusAf': 0.37, 'PowerWf': 1.89},
+    'ina219 aggregate': {f"{key}_{stat}": 1.2345 * i for i, (key, stat) in enumerate(
+        (key, stat) for key in ('Vbusf', 'IbusAf') for stat in ('min', 'max', 'mean', 'rms'))},
+}
+
+def run(number=50000):
+    for label, data in PAYLOADS.items():
+        schema = Schema(data)
+        print(f"\n{label}: {len(data)} keys")
+        print(f"{'codec':>8} {'bytes':>6} {'encode us':>10} {'decode us':>10}")
+        for name, factory in CODECS.items():
+            try:
+                codec = factory()
+            except ImportError as e:
+                print(f"{name:>8} skipped ({e})")
+                continue
+            payload = codec.encode(schema, data)
+            if isinstance(payload, str):
+                payload = payload.encode()  # What goes on the wire
+            decoded = codec.decode(payload, schema)
+            assert decoded == data, (name, decoded)
+            encode = min(timeit.repeat(lambda: codec.encode(schema, data), number=number, repeat=3)) / number * 1e6
+            decode = min(timeit.repeat(lambda: codec.decode(payload, schema), number=number, repeat=3)) / number * 1e6
+            print(f"{name:>8} {len(payload):>6} {encode:>10.2f} {decode:>10.2f}")
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,110 @@
+''' End to end throughput/latency with simulated devices and the in-process broker (package/sim.py)
+    N simulated INA219s go through setup_device, BusReader + Scheduler publish loop, Publisher and on_message.
+    A simulated Node-RED client counts published messages and sends commands stamped with perf_counter_ns.
+    Reports setup time, msgs/sec, p50/p99 command to handler latency and CPU per message.
+    Run from repo root: python3 -m benchmarks.bench_e2e [--devices 1 10 100] [--duration 5] '''
+import argparse, json, logging, threading
+from functools import partial
+from time import perf_counter_ns, process_time, sleep
+import demo_main_script as dms
+from package.busreader import BusReader
+from package.instrument import Histogram, Metrics
+from package.scheduler import Scheduler
+from package.sim import SimBroker, SimClient, SimPiINA219
+
+def quiet_logger(name):
+    logger = logging.getLogger(name)
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    logger.setLevel(logging.WARNING)
+    return logger
+
+def run(ndevices, duration=5, interval=0.05, nbuses=2, bus_time=0.0, cmd_rate=200, qos=0, window=None, ack_delay=0.0):
+    dms._loggers = []
+    dms.main_logger, dms.mqtt_logger = quiet_logger('bench.main'), quiet_logger('bench.mqtt')
+    dms.metrics = Metrics()
+    dms.MQTT_CLIENT_ID = 'pi'
+    dms.deviceD, dms.printcolor, dms.busreadtasks = dms.DeviceTable(), True, []
+    broker = SimBroker()
+    dms.mqtt_setup('sim', user='', password='', qos=qos, window=window)
+
+    latency = Histogram()
+    def command_handler(levels, payload):
+        latency.record(perf_counter_ns() - payload['t'])
+
+    busreader = BusReader(max_workers=nbuses, mlogger=dms.main_logger, metrics=dms.metrics)
+    t_setup = perf_counter_ns()
+    for i in range(ndevices):
+        device = f"ina{i}"
+        keys = [f"Vbusf{i}", f"IbusAf{i}", f"PowerWf{i}"]
+        dms.setup_device(device, device, 'pi', keys, interval=interval, cmd_handler=command_handler, heartbeat=1)
+        busreader.add_device(device, f"i2c{i % nbuses}", SimPiINA219(*keys, bus_time=bus_time).read)
+    setup_ms = (perf_counter_ns() - t_setup) / 1e6
+
+    client = SimClient('pi', broker=broker, ack_delay=ack_delay)
+    client.connected, client.failed_connection = False, False
+    client.on_connect, client.on_disconnect = dms.on_connect, dms.on_disconnect
+    client.on_message, client.on_publish = dms.on_message, dms.on_publish
+    dms.mqtt_client = client
+    dms.mqtt_publisher.client = client
+
+    received = [0]
+    def nodered_on_message(c, userdata, msg):
+        received[0] += 1
+    nodered = SimClient('nred', broker=broker)
+    nodered.on_message = nodered_on_message
+    nodered.connect('sim')
+    nodered.loop_start()
+    nodered.subscribe("pi2nred/+/pi")     # Device data only (not schema/metrics)
+    dms.mqtt_cmdqueue.start()
+    client.connect('sim')
+    client.loop_start()
+    while not client.connected:
+        sleep(0.01)
+
+    scheduler = Scheduler(mlogger=dms.main_logger)
+    dms.schedule_bus_reads(scheduler, busreader)
+    dms.reschedule = partial(scheduler.call_soon, 'reschedule', partial(dms.schedule_bus_reads, scheduler, busreader))
+    if dms.mqtt_flow is not None:
+        scheduler.add_task('flowcontrol', 0.5, dms.stretch_intervals)
+    stop = threading.Event()
+    sent = [0]
+    def commands():
+        i = 0
+        while not stop.wait(1 / cmd_rate):
+            nodered.publish(f"nred2pi/ina{i % ndevices}ZCMD/set", json.dumps({'t': perf_counter_ns()}))
+            sent[0] += 1
+            i += 1
+    threading.Thread(target=commands, daemon=True).start()
+    threading.Timer(duration, scheduler.stop).start()
+    cpu0 = process_time()
+    scheduler.run()
+    cpu = process_time() - cpu0
+    stop.set()
+    sleep(0.1)                              # Let in flight messages land
+    client.loop_stop()
+    nodered.loop_stop()
+    dms.mqtt_cmdqueue.stop()
+    busreader.shutdown()
+    messages = received[0] + sent[0]
+    return {'devices': ndevices, 'setup_ms': setup_ms, 'msgs_per_sec': received[0] / duration, 'cmds': sent[0], 'coalesced': dms.mqtt_cmdqueue.counters['coalesced'],
+            'p50_us': latency.percentile(50) / 1000, 'p99_us': latency.percentile(99) / 1000,
+            'cpu_us_per_msg': cpu / messages * 1e6 if messages else 0.0, 'late': sum(busreader.late.values()),
+            'failed': sum(busreader.failed.values()),
+            'held': dms.mqtt_flow.counters['blocked'] if dms.mqtt_flow is not None else 0,
+            'stretch': dms.mqtt_flow.stretch if dms.mqtt_flow is not None else 1}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--interval', type=float, default=0.05, help="device read/publish interval (sec)")
+    parser.add_argument('--bus-time', type=float, default=0.0, help="simulated I2C transaction time (sec)")
+    parser.add_argument('--qos', type=int, default=0)
+    parser.add_argument('--window', type=int, default=None, help="max publishes in flight (flow control). Default off")
+    parser.add_argument('--ack-delay', type=float, default=0.0, help="simulated broker ack time (sec)")
+    args = parser.parse_args()
+    print(f"{'devices':>7} {'setup ms':>9} {'msgs/sec':>9} {'cmds':>6} {'merged':>7} {'p50 us':>8} {'p99 us':>8} {'cpu us/msg':>11} {'late':>5} {'failed':>6} {'held':>6} {'stretch':>7}")
+    for ndevices in args.devices:
+        r = run(ndevices, args.duration, args.interval, bus_time=args.bus_time, qos=args.qos, window=args.window, ack_delay=args.ack_delay)
+        print(f"{r['devices']:>7} {r['setup_ms']:>9.1f} {r['msgs_per_sec']:>9.0f} {r['cmds']:>6} {r['coalesced']:>7} {r['p50_us']:>8.1f} {r['p99_us']:>8.1f} {r['cpu_us_per_msg']:>11.1f} {r['late']:>5} {r['failed']:>6} {r['held']:>6} {r['stretch']:>7}")
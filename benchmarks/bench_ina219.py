@@ -0,0 +1,41 @@
+''' Mmodule.device.read() against the simulated INA219 (package/sim.py)
+    separate  -- voltage() + current() calls, one bus transaction each (ina219 library path)
+    burst     -- registers() in one transaction with conversion ready polling and fixed point scaling
+    Reports reads/sec, bus transactions per read and reads per conversion (above 1 = the same conversion read again).
+    Run with a fast conversion rate to compare the per read cost, and a real rate (1000) to see conversion ready polling.
+    Run from repo root: python3 -m benchmarks.bench_ina219 [--bus-time 0 0.0003] [--rate 1000000 1000] [--duration 2] '''
+import argparse, logging
+from time import perf_counter
+from package.Mmodule import device
+from package.sim import SimINA219
+
+def run(burst, duration, rate, bus_time):
+    logger = logging.getLogger('bench.ina219')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    ina219 = SimINA219(rate=rate, bus_time=bus_time)
+    dev = device('Vbusf', 'IbusAf', mlogger=logger, ina219=ina219, burst=burst)
+    read = dev.read
+    reads = 0
+    t0 = perf_counter()
+    t_end = t0 + duration
+    while perf_counter() < t_end:
+        read()
+        reads += 1
+    elapsed = perf_counter() - t0
+    return {'mode': 'burst' if burst else 'separate', 'reads_per_sec': reads / elapsed, 'us_per_read': elapsed / reads * 1e6,
+            'transactions': ina219.reads / reads, 'per_conversion': reads / min(elapsed * rate, reads * 1.0), 'stale': dev.stale}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duration', type=float, default=2)
+    parser.add_argument('--rate', type=float, nargs='+', default=[1e6, 1000], help="simulated conversions/sec")
+    parser.add_argument('--bus-time', type=float, nargs='+', default=[0.0, 0.0003], help="sec per I2C transaction (0.0003 ~ 400kHz)")
+    args = parser.parse_args()
+    print(f"{'mode':>9} {'conv/sec':>9} {'bus us':>7} {'reads/sec':>10} {'us/read':>8} {'xfers/read':>11} {'reads/conv':>11} {'stale':>6}")
+    for rate in args.rate:
+        for bus_time in args.bus_time:
+            for burst in (False, True):
+                r = run(burst, args.duration, rate, bus_time)
+                print(f"{r['mode']:>9} {rate:>9.0f} {bus_time * 1e6:>7.0f} {r['reads_per_sec']:>10.0f} {r['us_per_read']:>8.1f} "
+                      f"{r['transactions']:>11.2f} {r['per_conversion']:>11.2f} {r['stale']:>6}")
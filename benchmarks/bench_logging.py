@@ -0,0 +1,93 @@
+''' Compare setup_logging synchronous handlers vs queue mode (use_queue=True)
+    Reports records/sec seen by the caller and jitter (avg/p99/max) of a 1 ms loop that logs every pass, for
+    fast     -- writes go to the page cache and never block (a dev machine)
+    stalled  -- every --stall-every'th write blocks for --stall sec, like SD card write back or a full stderr pipe on a Pi
+    Queue mode is for the stalled case: the listener thread blocks instead of the loop. With fast writes the two are close.
+    The queue backlog from the throughput test is drained first, otherwise the listener writing it holds the GIL
+    while the loop is measured (earlier versions of this benchmark reported that as queue mode jitter)
+    Run from repo root: python3 -m benchmarks.bench_logging [--stall 0.02] [--stall-every 50] '''
+import argparse, itertools, sys, os, logging, tempfile
+from logging.handlers import QueueHandler
+from time import perf_counter, sleep
+import demo_main_script as dms
+
+def make_logger(log_dir, name, use_queue):
+    stderr, sys.stderr = sys.stderr, open(os.devnull, 'w')  # Console handler binds stderr at creation. Keep the terminal quiet
+    try:
+        return dms.setup_logging(log_dir, 'custom', name, log_level=logging.DEBUG, mode=2, use_queue=use_queue)
+    finally:
+        sys.stderr = stderr
+
+def stall_writes(logger, stall, every):
+    ''' Make every every'th emit of the logger's output handlers block for stall sec (sleep releases the GIL like blocking I/O) '''
+    handlers = list(dms._log_handlers.values()) if any(isinstance(h, QueueHandler) for h in logger.handlers) else logger.handlers
+    for handler in handlers:
+        emit, count = handler.emit, itertools.count()
+        def stalled_emit(record, emit=emit, count=count):
+            if next(count) % every == 0:
+                sleep(stall)
+            emit(record)
+        handler.emit = stalled_emit
+
+def drain():
+    ''' Wait for the listener to write the throughput backlog so it does not compete (GIL) with the jitter loop '''
+    while dms._log_queue is not None and not dms._log_queue.empty():
+        sleep(0.01)
+
+def throughput(logger, nrecords=20000):
+    t0 = perf_counter()
+    for i in range(nrecords):
+        logger.debug('{0}, {1}, {2}'.format(0x40, i, 3.3))
+    return nrecords / (perf_counter() - t0)
+
+def loop_jitter(logger, interval=0.001, loops=2000):
+    ''' Deadline driven loop that logs each pass. Returns (avg, p99, max) lateness in ms '''
+    lateness = []
+    deadline = perf_counter() + interval
+    for i in range(loops):
+        delay = deadline - perf_counter()
+        if delay > 0:
+            sleep(delay)            # Sleep like the scheduler does so the listener thread can run while idle
+        lateness.append(perf_counter() - deadline)
+        logger.info('sample {0}'.format(i))
+        deadline += interval
+    lateness.sort()
+    return sum(lateness) / len(lateness) * 1000, lateness[int(len(lateness) * 0.99)] * 1000, lateness[-1] * 1000
+
+def guarded_skip(logger, nrecords=200000):
+    ''' Cost of a disabled debug call with and without an isEnabledFor guard (us/call) '''
+    logger.setLevel(logging.INFO)
+    t0 = perf_counter()
+    for i in range(nrecords):
+        logger.debug('{0}, {1}'.format(i, 3.3))
+    unguarded = (perf_counter() - t0) / nrecords * 1e6
+    t0 = perf_counter()
+    for i in range(nrecords):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('{0}, {1}'.format(i, 3.3))
+    guarded = (perf_counter() - t0) / nrecords * 1e6
+    logger.setLevel(logging.DEBUG)
+    return unguarded, guarded
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stall', type=float, default=0.02, help="sec a stalled write blocks")
+    parser.add_argument('--stall-every', type=int, default=50, help="every Nth write stalls")
+    args = parser.parse_args()
+    dms._loggers = []
+    print(f"{'writes':>8} {'mode':>6} {'records/sec':>12} {'jitter avg ms':>14} {'p99 ms':>7} {'max ms':>7} {'debug off us':>13} {'guarded us':>11}")
+    for scenario in ('fast', 'stalled'):
+        for use_queue in (False, True):
+            with tempfile.TemporaryDirectory() as log_dir:
+                logger = make_logger(log_dir, f"bench_{scenario}_{'queue' if use_queue else 'sync'}", use_queue)
+                if scenario == 'stalled':
+                    stall_writes(logger, args.stall, args.stall_every)
+                rate = throughput(logger, nrecords=20000 if scenario == 'fast' else 2000)
+                drain()
+                jitter_avg, jitter_p99, jitter_max = loop_jitter(logger)
+                unguarded, guarded = guarded_skip(logger)
+                dms.stop_log_listener()     # Drains the queue. The next run starts a fresh listener and handlers
+                for handler in logger.handlers:
+                    handler.close()
+            print(f"{scenario:>8} {'queue' if use_queue else 'sync':>6} {rate:>12.0f} {jitter_avg:>14.3f} {jitter_p99:>7.3f} {jitter_max:>7.3f}"
+                  f" {unguarded:>13.2f} {guarded:>11.2f}")
@@ -0,0 +1,55 @@
+''' Cold start: fresh interpreter -> imports -> device registry loaded, devices set up and drivers created (simulated drivers).
+    Each run is a new process so import caches do not help. Reports median/max wall time and the import vs setup split.
+    Exits 1 if the median is over --target so it can gate changes (run it on the Pi Zero for the real number).
+    Run from repo root: python3 -m benchmarks.bench_startup [--runs 10] [--target 3.0] [--devices devices.json] '''
+import argparse, json, statistics, subprocess, sys
+from time import perf_counter
+
+def child(devices):
+    t0 = perf_counter()
+    import logging
+    import demo_main_script as dms
+    from package.registry import DeviceRegistry
+    t_import = perf_counter()
+    logger = logging.getLogger('bench.startup')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    dms._loggers, dms.main_logger, dms.mqtt_logger = [], logger, logger
+    dms.metrics = dms.Metrics()
+    dms.MQTT_CLIENT_ID = 'pi'
+    dms.deviceD, dms.printcolor = dms.DeviceTable(), True
+    dms.mqtt_setup('sim', user='', password='')
+    registry = DeviceRegistry.from_file(devices, simulate=True, mlogger=logger)
+    for spec in registry.devices:
+        dms.setup_device(spec['name'], spec['lvl2'], dms.MQTT_CLIENT_ID + spec['publvl3'], spec['data_keys'],
+                         interval=spec['interval'], deadband=spec['deadband'], heartbeat=spec['heartbeat'])
+        registry.create(spec, logger)
+    print(json.dumps({'import': t_import - t0, 'setup': perf_counter() - t_import, 'modules': len(sys.modules)}))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--target', type=float, default=3.0, help="sec. Pi Zero budget for the median cold start")
+    parser.add_argument('--devices', default='devices.json')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.devices)
+        return
+    walls, phases = [], []
+    for i in range(args.runs):
+        t0 = perf_counter()
+        out = subprocess.run([sys.executable, '-m', 'benchmarks.bench_startup', '--child', '--devices', args.devices],
+                             check=True, capture_output=True, text=True).stdout
+        walls.append(perf_counter() - t0)
+        phases.append(json.loads(out.splitlines()[-1]))
+    median = statistics.median(walls)
+    print(f"{'runs':>5} {'median s':>9} {'max s':>7} {'import s':>9} {'setup s':>8} {'modules':>8} {'target s':>9}")
+    print(f"{args.runs:>5} {median:>9.3f} {max(walls):>7.3f} {statistics.median(p['import'] for p in phases):>9.3f} "
+          f"{statistics.median(p['setup'] for p in phases):>8.3f} {phases[-1]['modules']:>8} {args.target:>9.3f}")
+    if median > args.target:
+        print(f"Cold start {median:.3f} sec is over the {args.target} sec target")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+''' Compare on_message dispatch cost. Original regex + if/elif chain vs TopicRouter trie
+    Run from repo root: python3 -m benchmarks.bench_topicrouter '''
+import re, json, timeit
+from package.topicrouter import TopicRouter
+
+SUB_LVL1 = 'nred2pi'
+MQTT_REGEX = SUB_LVL1 + '/([^/]+)/([^/]+)'
+
+def regex_dispatch(lvl2s, state):
+    ''' Original on_message path. Match regex, decode payload (twice in debug), walk if/elif chain over lvl2 names '''
+    def on_message(topic, payload):
+        msgmatch = re.match(MQTT_REGEX, topic)
+        if msgmatch:
+            mqtt_payload = json.loads(str(payload.decode("utf-8", "ignore")))
+            mqtt_topic = [msgmatch.group(0), msgmatch.group(1), msgmatch.group(2), type(mqtt_payload)]
+            for lvl2 in lvl2s:          # Equivalent of one elif per device
+                if mqtt_topic[1] == lvl2:
+                    state[lvl2] = mqtt_payload
+                    break
+    return on_message
+
+def router_dispatch(lvl2s, state):
+    router = TopicRouter()
+    for lvl2 in lvl2s:
+        router.add(f"{SUB_LVL1}/{lvl2}/+", lambda levels, payload, lvl2=lvl2: state.__setitem__(lvl2, payload))
+    def on_message(topic, payload):
+        router.dispatch(topic, json.loads(payload.decode("utf-8", "ignore")))
+    return on_message
+
+def run(ndevices, number=20000):
+    lvl2s = [f"dev{i}ZCMD" for i in range(ndevices)]
+    topic = f"{SUB_LVL1}/{lvl2s[-1]}/0"       # Worst case for the if/elif chain
+    payload = b'{"angle": 90}'
+    results = {}
+    for name, factory in (('regex', regex_dispatch), ('router', router_dispatch)):
+        state = {}
+        on_message = factory(lvl2s, state)
+        on_message(topic, payload)
+        assert state[lvl2s[-1]] == {'angle': 90}
+        results[name] = min(timeit.repeat(lambda: on_message(topic, payload), number=number, repeat=3)) / number * 1e6
+    return results
+
+if __name__ == "__main__":
+    print(f"{'topics':>7} {'regex us/msg':>13} {'router us/msg':>14}")
+    for ndevices in (1, 10, 100, 500, 1000):
+        r = run(ndevices)
+        print(f"{ndevices:>7} {r['regex']:>13.2f} {r['router']:>14.2f}")
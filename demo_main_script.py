@@ -1,10 +1,20 @@
-import sys, json, logging, re
-import RPi.GPIO as GPIO
-from time import sleep, perf_counter
-import paho.mqtt.client as mqtt
+import sys, json, logging, queue, argparse, atexit
+from time import sleep, perf_counter, perf_counter_ns, time
+T_START = perf_counter()            # Cold start is logged once devices are set up (see benchmarks/bench_startup.py)
+from functools import partial
 from os import path
 from pathlib import Path
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from package.scheduler import Scheduler
+from package.topicrouter import TopicRouter
+from package.publisher import Publisher
+from package.spool import Spool, SpoolReplayer
+from package.busreader import BusReader
+from package.codec import get_codec
+from package.instrument import Metrics, ProfileRunner, timed
+from package.cmdqueue import CommandQueue
+from package.flowcontrol import FlowControl
+from package.registry import DeviceRegistry, DeviceRecord, DeviceTable
 
 class pcolor:
     ''' Add color to print statements '''
@@ -47,13 +57,63 @@ class CustomFormatter(logging.Formatter):
         logging.CRITICAL: bold_red + format + reset
     }
 
+    def __init__(self):
+        super().__init__()
+        self.formatters = {level: logging.Formatter(fmt) for level, fmt in self.FORMATS.items()} # Build once, not per record
+
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
+        formatter = self.formatters.get(record.levelno)
+        if formatter is None:
+            formatter = self.formatters[logging.INFO]
         return formatter.format(record)
 
-def setup_logging(log_dir, logger_type, logger_name=__name__, log_level=logging.INFO, mode=1):
-    ''' Create basic or custom loggers with RotatingFileHandler '''
+class LoggerRouter(logging.Handler):
+    ''' Runs in the QueueListener thread. Sends each record to the handlers registered for its logger name '''
+
+    def __init__(self):
+        super().__init__()
+        self.routes = {}        # logger name -> [(level, handler)]
+
+    def handle(self, record):
+        for level, handler in self.routes.get(record.name, ()):
+            if record.levelno >= level:
+                handler.handle(record)
+        return True
+
+_log_queue = None       # Queue mode. All custom loggers put records on one queue
+_log_listener = None    # Single background thread that owns every console/file handler
+_log_router = None
+_log_handlers = {}      # Shared handlers (console, one RotatingFileHandler per file) so files are only opened once
+
+def start_log_listener():
+    ''' Start the background thread that writes queued log records '''
+    global _log_queue, _log_listener, _log_router
+    if _log_listener is None:
+        _log_queue = queue.SimpleQueue()
+        _log_router = LoggerRouter()
+        _log_listener = QueueListener(_log_queue, _log_router)
+        _log_listener.start()
+        atexit.register(stop_log_listener)  # The listener thread is a daemon. Flush on every exit path (sys.exit, exceptions)
+
+def stop_log_listener():
+    ''' Flush queued records and stop the listener thread. Call on exit '''
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+        for handler in _log_handlers.values():
+            handler.close()
+        _log_handlers.clear()
+
+def _shared_handler(name, factory):
+    handler = _log_handlers.get(name)
+    if handler is None:
+        handler = _log_handlers[name] = factory()
+    return handler
+
+def setup_logging(log_dir, logger_type, logger_name=__name__, log_level=logging.INFO, mode=1, use_queue=False):
+    ''' Create basic or custom loggers with RotatingFileHandler
+        use_queue=True (custom only) logs through a QueueHandler so file/console I/O happens in one background thread '''
     global _loggers
     # logger_type = basic
     # logger_type = custom with log file options below
@@ -90,21 +150,39 @@ def setup_logging(log_dir, logger_type, logger_name=__name__, log_level=logging.
         log_file_format = logging.Formatter("[%(levelname)s] - %(asctime)s - %(name)s - : %(message)s in %(pathname)s:%(lineno)d")
         #log_console_format = logging.Formatter("[%(levelname)s]: %(message)s") # Using CustomFormatter Class
 
-        console_handler = logging.StreamHandler()
-        console_handler.setLevel(console_log_level)
-        console_handler.setFormatter(CustomFormatter())
+        if use_queue:
+            start_log_listener()
+            def file_handler(filename):
+                handler = RotatingFileHandler('{}/{}'.format(log_dir, filename), maxBytes=10**6, backupCount=5) # 1MB file
+                handler.setFormatter(log_file_format)
+                return handler
+            def stream_handler():
+                handler = logging.StreamHandler()
+                handler.setFormatter(CustomFormatter())
+                return handler
+            # Handlers are shared by every logger and owned by the listener thread. Level is applied per logger by LoggerRouter
+            _log_router.routes[logger_name] = [
+                (console_log_level, _shared_handler('console', stream_handler)),
+                (logfile_log_level, _shared_handler('{}/debug.log'.format(log_dir), partial(file_handler, 'debug.log'))),
+                (logging.WARNING, _shared_handler('{}/error.log'.format(log_dir), partial(file_handler, 'error.log')))]
+            if not any(isinstance(handler, QueueHandler) for handler in custom_logger.handlers):
+                custom_logger.addHandler(QueueHandler(_log_queue))
+        else:
+            console_handler = logging.StreamHandler()
+            console_handler.setLevel(console_log_level)
+            console_handler.setFormatter(CustomFormatter())
 
-        log_file_handler = RotatingFileHandler('{}/debug.log'.format(log_dir), maxBytes=10**6, backupCount=5) # 1MB file
-        log_file_handler.setLevel(logfile_log_level)
-        log_file_handler.setFormatter(log_file_format)
+            log_file_handler = RotatingFileHandler('{}/debug.log'.format(log_dir), maxBytes=10**6, backupCount=5) # 1MB file
+            log_file_handler.setLevel(logfile_log_level)
+            log_file_handler.setFormatter(log_file_format)
 
-        log_errors_file_handler = RotatingFileHandler('{}/error.log'.format(log_dir), maxBytes=10**6, backupCount=5)
-        log_errors_file_handler.setLevel(logging.WARNING)
-        log_errors_file_handler.setFormatter(log_file_format)
+            log_errors_file_handler = RotatingFileHandler('{}/error.log'.format(log_dir), maxBytes=10**6, backupCount=5)
+            log_errors_file_handler.setLevel(logging.WARNING)
+            log_errors_file_handler.setFormatter(log_file_format)
 
-        custom_logger.addHandler(console_handler)
-        custom_logger.addHandler(log_file_handler)
-        custom_logger.addHandler(log_errors_file_handler)
+            custom_logger.addHandler(console_handler)
+            custom_logger.addHandler(log_file_handler)
+            custom_logger.addHandler(log_errors_file_handler)
     if custom_logger not in _loggers: _loggers.append(custom_logger)
     return custom_logger
                 
@@ -113,9 +191,9 @@ def on_connect(client, userdata, flags, rc):
     main_logger.info("attempting on_connect")
     if rc==0:
         mqtt_client.connected = True
-        for topic in MQTT_SUB_TOPIC:
-            client.subscribe(topic)
-            main_logger.info("Subscribed to: {0}\n".format(topic))
+        client.subscribe([(topic, 0) for topic in MQTT_SUB_TOPIC])  # One SUBSCRIBE for every device topic (list built in setup_device)
+        main_logger.info("Subscribed to: {0}\n".format(list(MQTT_SUB_TOPIC)))
+        mqtt_publisher.announce()             # Retained payload schema per publish topic (codec + key order)
         main_logger.info("Successful Connection: {0}".format(str(rc)))
     else:
         mqtt_client.failed_connection = True  # If rc != 0 then failed to connect. Set flag to stop mqtt loop
@@ -123,56 +201,106 @@ def on_connect(client, userdata, flags, rc):
 
 def on_message(client, userdata, msg):
     """on message callback will receive messages from the server/broker. Must be subscribed to the topic in on_connect"""
-    global MQTT_REGEX, mqtt_dummy1, mqtt_dummy2
-    mqtt_logger.debug("Received: {0} with payload: {1}".format(msg.topic, str(msg.payload)))
-    msgmatch = re.match(MQTT_REGEX, msg.topic)   # Check for match to subscribed topics
-    if msgmatch:
-        mqtt_payload = json.loads(str(msg.payload.decode("utf-8", "ignore"))) 
-        mqtt_topic = [msgmatch.group(0), msgmatch.group(1), msgmatch.group(2), type(mqtt_payload)] # breaks msg topic into groups - group/group1/group2
-        if mqtt_topic[2] == 'group2A':
-            mqtt_dummy1 = mqtt_payload
-        elif mqtt_topic[2] == 'group2B':
-            mqtt_dummy2 = mqtt_payload
+    mqtt_cmdqueue.put(msg.topic, msg.payload)   # Runs on paho network thread. Decode/handle in the command worker (handle_message)
+
+def handle_message(topic, payload):
+    """ Command worker. Decode the payload once and dispatch to the handlers registered in setup_device """
+    t0 = perf_counter_ns()
+    try:
+        mqtt_payload = mqtt_cmd_codec.decode(payload)  # Decode once. Handlers get the python object
+    except ValueError:
+        mqtt_logger.warning("Could not decode {0} payload on {1}: {2}".format(mqtt_cmd_codec.name, topic, payload))
+        return
     # If Debugging will print the JSON incoming payload and unpack it
-    if mqtt_logger.getEffectiveLevel() == 10:
-        mqtt_logger.debug("Topic grp0:{0} grp1:{1} grp2:{2}".format(msgmatch.group(0), msgmatch.group(1), msgmatch.group(2)))
-        mqtt_payload = json.loads(str(msg.payload.decode("utf-8", "ignore")))
+    if mqtt_logger.isEnabledFor(logging.DEBUG):
+        mqtt_logger.debug("Received: {0} with payload: {1}".format(topic, str(payload)))
         mqtt_logger.debug("Payload type:{0}".format(type(mqtt_payload)))
-        if isinstance(mqtt_payload, (str, bool, int, float)):
-            mqtt_logger.debug(mqtt_payload)
-        elif isinstance(mqtt_payload, list):
-            mqtt_logger.debug(mqtt_payload)
-        elif isinstance(mqtt_payload, dict):
-            for key, value in mqtt_payload.items():  
+        if isinstance(mqtt_payload, dict):
+            for key, value in mqtt_payload.items():
                 mqtt_logger.debug("{0}:{1}".format(key, value))
+        else:
+            mqtt_logger.debug(mqtt_payload)
+    if not mqtt_router.dispatch(topic, mqtt_payload):
+        mqtt_logger.debug("No handler for {0}".format(topic))
+    metrics.record('dispatch', topic.split('/', 2)[1] if topic.count('/') else topic, perf_counter_ns() - t0) # per sub lvl2
+
+def device_command(device, levels, payload):
+    """ Default command handler registered by setup_device. Stores latest payload per lvl3 (ie deviceD['servo'].cmd['0']) """
+    deviceD[device].cmd[levels[2]] = payload
+
+def interval_command(device, levels, payload):
+    """ {lvl2}ZCMD/interval handler. Node-RED sets the device read/publish interval (sec) at runtime """
+    record = deviceD[device]
+    if record.interval is None:
+        main_logger.warning(f"{device} is interrupt driven. Ignoring interval {payload}")
+        return
+    try:
+        interval = float(payload)
+    except (TypeError, ValueError):
+        interval = 0
+    if interval <= 0:
+        main_logger.warning(f"{device} interval must be a number > 0, got {payload}")
+        return
+    record.interval = interval
+    record.msginterval = interval * (mqtt_flow.stretch if mqtt_flow is not None else 1)
+    main_logger.info(f"{device} interval set to {interval} sec")
+    if reschedule is not None:
+        reschedule()
+
+def stretch_intervals():
+    """ Flow control task. Stretch every polled device interval while publishes back up, restore once the window drains """
+    stretch = mqtt_flow.update()
+    if stretch is None:
+        return
+    for record in deviceD.values():
+        if record.interval is not None:
+            record.msginterval = record.interval * stretch
+    if reschedule is not None:
+        reschedule()
 
 def on_publish(client, userdata, mid):
     """on publish will send data to client"""
-    mqtt_logger.debug("msg ID: " + str(mid)) 
-    pass 
+    if mqtt_flow is not None:
+        mqtt_flow.acked(mid)                  # Frees a slot in the in-flight window
+    if mqtt_logger.isEnabledFor(logging.DEBUG):
+        mqtt_logger.debug("msg ID: " + str(mid))
 
 def on_disconnect(client, userdata,rc=0):
     main_logger.info("DisConnected result code "+str(rc))
-    mqtt_client.loop_stop()
-
-def mqtt_setup(IPaddress):
-    global MQTT_SERVER, MQTT_CLIENT_ID, MQTT_USER, MQTT_PASSWORD, MQTT_SUB_TOPIC, MQTT_PUB_LVL1, MQTT_SUB_LVL1, MQTT_REGEX
-    global mqtt_client
-    home = str(Path.home())                       # Import mqtt and wifi info. Remove if hard coding in python script
-    with open(path.join(home, "stem"),"r") as f:
-        user_info = f.read().splitlines()
+    mqtt_client.connected = False             # Publisher spools outgoing data until on_connect reports rc==0 again
+    if mqtt_flow is not None and mqtt_publisher.qos == 0:
+        mqtt_flow.clear()                     # Unsent QoS0 messages are dropped by paho without on_publish. QoS1 are resent
+    if rc == 0:                               # Requested disconnect. Unexpected disconnects keep the loop running so paho reconnects
+        mqtt_client.loop_stop()
+
+def mqtt_setup(IPaddress, batch=False, spool=None, codec='json', cmd_codec='json', user=None, password=None, qos=0, window=None):
+    ''' qos for device data. window = max publishes in flight (not yet acked in on_publish). None = no flow control '''
+    global MQTT_SERVER, MQTT_CLIENT_ID, MQTT_USER, MQTT_PASSWORD, MQTT_SUB_TOPIC, MQTT_PUB_LVL1, MQTT_SUB_LVL1, MQTT_METRICS_TOPIC
+    global mqtt_client, mqtt_router, mqtt_publisher, mqtt_cmd_codec, mqtt_cmdqueue, mqtt_flow, reschedule
+    if user is None:
+        home = str(Path.home())                       # Import mqtt and wifi info. Remove if hard coding in python script
+        with open(path.join(home, "stem"),"r") as f:
+            user_info = f.read().splitlines()
+        user, password = user_info[0], user_info[1]
     MQTT_SERVER = IPaddress                    # Replace with IP address of device running mqtt server/broker
-    MQTT_USER = user_info[0]                   # Replace with your mqtt user ID
-    MQTT_PASSWORD = user_info[1]               # Replace with your mqtt password
+    MQTT_USER = user                           # Replace with your mqtt user ID
+    MQTT_PASSWORD = password                   # Replace with your mqtt password
     # Specific MQTT SUBSCRIBE/PUBLISH TOPICS created inside 'setup_device' function
-    MQTT_SUB_TOPIC = []
+    MQTT_SUB_TOPIC = {}                        # Ordered set of subscription topics
     MQTT_SUB_LVL1 = 'nred2' + MQTT_CLIENT_ID
-    MQTT_REGEX = MQTT_SUB_LVL1 + '/([^/]+)/([^/]+)' # 'nred2pi/+' would also work but would not return groups
-                                              # () group capture. Useful for getting topic lvls in on_message
-                                              # [^/] match a char except /. Needed to get topic lvl2, lvl3 groups
-                                              # + will match one or more. Requiring at least 1 match forces a lvl1/lvl2/lvl3 topic structure
-                                              # * could also be used for last group and then a lvl1/lvl2 topic would also be matched
+    mqtt_router = TopicRouter()               # on_message dispatch. Handlers are registered per subscription topic in 'setup_device'
+                                              # levels passed to handlers are [lvl1, lvl2, lvl3] of the received topic
     MQTT_PUB_LVL1 = 'pi2nred/'
+    MQTT_METRICS_TOPIC = MQTT_PUB_LVL1 + 'metrics/' + MQTT_CLIENT_ID # Stage latency histograms + scheduler/publish stats for Node-RED charts
+    mqtt_flow = FlowControl(window, mlogger=mqtt_logger) if window else None # In-flight window. Stretches device intervals under congestion
+    reschedule = None                         # Regroups bus read tasks after a device interval change. Set once the scheduler exists
+    mqtt_publisher = Publisher(batch=batch, mlogger=mqtt_logger, spool=spool, codec=get_codec(codec), metrics=metrics,
+                               flow=mqtt_flow, qos=qos) # Deadband/heartbeat/batching stage between deviceD and mqtt_client
+    mqtt_cmd_codec = get_codec(cmd_codec)     # Inbound commands. Needs a self describing codec (json, msgpack, cbor)
+    # Inbound commands are handed off the network thread. Pending commands on the same topic are coalesced (latest wins)
+    # Priority topics (ie stop) skip the queue and are handled immediately on the network thread
+    mqtt_cmdqueue = CommandQueue(handle_message, priority=[MQTT_SUB_LVL1 + '/+/stop', MQTT_SUB_LVL1 + '/+/estop'], mlogger=mqtt_logger)
+                                              # Devices are added in 'setup_device'. Client is linked once it is created in main
 
     # MQTT STRUCTURE - TOPIC/PAYLOAD
     # TOPIC levels --> lvl1/lvl2/lvl3
@@ -220,42 +348,120 @@ def mqtt_setup(IPaddress):
     # Final NodeRed payload: fields[key]  data is accessed with msg.payload[0].key
     #                        tags(topic levels) are access with msg.payload[1].lvlx (lvl1, lvl2, lvl3)
 
-def setup_device(device, lvl2, publvl3, data_keys):
+def setup_device(device, lvl2, publvl3, data_keys, interval=1, cmd_handler=None, deadband=None, heartbeat=10):
+    ''' deadband {data_key: limit} suppresses publishing until a value moves more than limit (absolute 0.05 or percent '2%')
+        heartbeat forces a publish every N intervals even if nothing changed (0 = only on change) '''
     global printcolor, deviceD
-    if deviceD.get(device) == None:
-        deviceD[device] = {}
-        deviceD[device]['data'] = {}
-        deviceD[device]['lvl2'] = lvl2 # Sub/Pub lvl2 in topics. Does not have to be unique, can piggy-back on another device lvl2
-        topic = f"{MQTT_SUB_LVL1}/{deviceD[device]['lvl2']}ZCMD/+"
-        if topic not in MQTT_SUB_TOPIC:
-            MQTT_SUB_TOPIC.append(topic)
-            for key in data_keys:
-                deviceD[device]['data'][key] = 0
-        else:
-            for key in data_keys:
-                for item in deviceD:
-                    if deviceD[item]['data'].get(key) != None:
-                        main_logger.warning(f"**DUPLICATE WARNING {device} and {item} are both publishing {key} on {topic}")
-                deviceD[device]['data'][key] = 0
-        deviceD[device]['pubtopic'] = MQTT_PUB_LVL1 + lvl2 + '/' + publvl3
-        deviceD[device]['send'] = False
+    if device not in deviceD:
+        record = DeviceRecord(device, lvl2, interval, data_keys, subtopic=f"{MQTT_SUB_LVL1}/{lvl2}ZCMD/+",
+                              pubtopic=MQTT_PUB_LVL1 + lvl2 + '/' + publvl3, schematopic=MQTT_PUB_LVL1 + 'schema/' + lvl2 + '/' + publvl3)
+        topic = record.subtopic
+        for key, item in deviceD.add(record):   # Keys another device already publishes on this lvl2
+            main_logger.warning(f"**DUPLICATE WARNING {device} and {item} are both publishing {key} on {topic}")
+        MQTT_SUB_TOPIC[topic] = None
+        # cmd_handler(levels, payload) is called for messages on the device sub topic. Shared lvl2 topics call every device handler
+        mqtt_router.add(topic, cmd_handler if cmd_handler is not None else partial(device_command, device))
+        mqtt_router.add(topic[:-1] + 'interval', partial(interval_command, device)) # Runtime rate change from Node-RED (sec)
+        mqtt_publisher.add_device(device, record.pubtopic, record.lvl2, keys=record.keys, deadband=deadband, heartbeat=heartbeat,
+                                  schema_topic=record.schematopic)
         printcolor = not printcolor # change color of every other print statement
         if printcolor: 
             main_logger.info(f"{pcolor.LBLUE}{device} Subscribing to: {topic}{pcolor.ENDC}")
-            main_logger.info(f"{pcolor.DBLUE}{device} Publishing  to: {deviceD[device]['pubtopic']}{pcolor.ENDC}")
-            main_logger.info(f"JSON payload keys will be:{pcolor.WOLB}{*deviceD[device]['data'],}{pcolor.ENDC}")
+            main_logger.info(f"{pcolor.DBLUE}{device} Publishing  to: {record.pubtopic}{pcolor.ENDC}")
+            main_logger.info(f"JSON payload keys will be:{pcolor.WOLB}{record.keys}{pcolor.ENDC}")
         else:
             main_logger.info(f"{pcolor.PURPLE}{device} Subscribing to: {topic}{pcolor.ENDC}")
-            main_logger.info(f"{pcolor.LPURPLE}{device} Publishing  to: {deviceD[device]['pubtopic']}{pcolor.ENDC}")
-            main_logger.info(f"JSON payload keys will be:{pcolor.WOP}{*deviceD[device]['data'],}{pcolor.ENDC}")
+            main_logger.info(f"{pcolor.LPURPLE}{device} Publishing  to: {record.pubtopic}{pcolor.ENDC}")
+            main_logger.info(f"JSON payload keys will be:{pcolor.WOP}{record.keys}{pcolor.ENDC}")
+        main_logger.info(f"{device} interval: {interval if interval is not None else 'interrupt driven'}")
     else:
         main_logger.error(f"Device {device} already in use. Device name should be unique")
         sys.exit(f"{pcolor.RED}Device {device} already in use. Device name should be unique{pcolor.ENDC}")
 
+def publish_data(device, data):
+    ''' Scheduler callback with the result of the device read. Store and publish if the device returned new data '''
+    if data is not None:
+        deviceD[device].data = data
+        mqtt_publisher.submit(device, data)
+
+def publish_bus_reads(reads):
+    ''' Scheduler callback with BusReader.read result. Late and failed devices keep their previous data. Late ones are flagged
+        (failed reads are already logged by BusReader) '''
+    results, late, failed = reads
+    for device, data in results.items():
+        deviceD[device].late = False
+        publish_data(device, data)
+    for device in late:
+        deviceD[device].late = True
+        main_logger.warning(f"{device} missed the read deadline")
+
+def schedule_bus_reads(scheduler, busreader, deadline=0.8):
+    ''' One scheduler task per distinct device interval. Devices due on a tick are read with buses in parallel.
+        deadline is the fraction of the interval the tick waits for reads. Call again after changing a device msginterval '''
+    global busreadtasks
+    for name in busreadtasks:
+        scheduler.remove_task(name)
+    groups = {}
+    for device in busreader.devices():
+        groups.setdefault(deviceD[device].msginterval, []).append(device)
+    busreadtasks = []
+    for interval, devices in groups.items():
+        name = f"busread@{interval}s"
+        scheduler.add_task(name, interval, publish_bus_reads, read=partial(busreader.read, devices, interval * deadline))
+        busreadtasks.append(name)
+
+def publish_shard_reads(table, devices, seen):
+    ''' Scheduler task with sharding. Publish readings the shard workers wrote to the shared table since the last pass.
+        seen {device: table version} of the last published reading '''
+    now = time()
+    for device in devices:
+        reading = table.read(device)
+        if reading is None:             # Worker kept writing through every retry. Next pass
+            continue
+        version, stamp, values = reading
+        record = deviceD[device]
+        if version != seen.get(device, 0):
+            seen[device] = version
+            record.late = False
+            publish_data(device, {key: None if value != value else value for key, value in zip(record.keys, values)}) # NaN (missing) -> null. JSON has no NaN
+        elif version and not record.late and now - stamp > 2 * record.msginterval:   # Worker stalled or restarting
+            record.late = True
+            main_logger.warning(f"{device} has no new reading for {now - stamp:.1f} sec")
+
+def push_shard_intervals(table):
+    ''' reschedule with sharding. Shard workers pick up msginterval changes from the table '''
+    for device in table.layout:
+        table.set_interval(device, deviceD[device].msginterval)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="python-nodered mqtt link")
+    parser.add_argument('--profile', action='store_true', help="cProfile the main loop thread and dump .prof files on a schedule")
+    parser.add_argument('--profile-interval', type=float, default=300, help="sec between profile dumps (default 300)")
+    parser.add_argument('--profile-dir', default=path.join(path.dirname(path.abspath(__file__)), 'profiles'), help="where .prof files are written")
+    parser.add_argument('--profile-baseline', default=None, help="saved .prof file. Each dump logs the largest per call changes vs it")
+    parser.add_argument('--simulate', action='store_true', help="simulated GPIO, sensors and in-process broker (package/sim.py). Runs off the Pi")
+    parser.add_argument('--runtime', choices=('thread', 'asyncio'), default='thread',
+                        help="thread = paho loop_start() thread + Scheduler. asyncio = one event loop for the mqtt socket and devices (package/aioruntime.py)")
+    parser.add_argument('--shards', type=int, default=0, help="run polled devices in N worker processes (package/shard.py). 0 = one process")
+    parser.add_argument('--devices', default=path.join(path.dirname(path.abspath(__file__)), 'devices.json'),
+                        help="device registry file (.json, .toml, .yaml). See package/registry.py")
+    args = parser.parse_args()
+    if args.runtime == 'asyncio' and args.simulate:
+        parser.error("--runtime asyncio needs a real paho client. The simulated broker has no socket")
+    return args
+
 def main():
     global deviceD, printcolor      # Containers setup in 'create' functions and used for Publishing mqtt
     global MQTT_SERVER, MQTT_USER, MQTT_PASSWORD, MQTT_CLIENT_ID, mqtt_client, MQTT_PUB_LVL1
-    global _loggers, main_logger, mqtt_logger
+    global _loggers, main_logger, mqtt_logger, busreadtasks, metrics, GPIO, mqtt, reschedule
+
+    args = parse_args()
+    if args.simulate:               # Simulated backends only when asked for. A Pi missing paho/RPi.GPIO must fail, not fake it
+        from package import sim
+        GPIO, mqtt = sim.GPIO, sim.mqtt
+    else:
+        import RPi.GPIO as GPIO
+        import paho.mqtt.client as mqtt
 
     main_logger_level= logging.DEBUG # CRITICAL=logging off. DEBUG=get variables. INFO=status messages.
     main_logger_type = 'custom'       # 'basic' or 'custom' (with option for log files)
@@ -270,39 +476,67 @@ def main():
                 #      DEBUG,2     |  info+debug | print+logfile
                 #      DEBUG,3     |  info+debug | logfile
     
+    log_queue = True # True = loggers hand records to one background thread (QueueListener) so file/console I/O never stalls the main loop
     _loggers = [] # container to keep track of loggers created
-    main_logger = setup_logging(path.dirname(path.abspath(__file__)), main_logger_type, log_level=main_logger_level, mode=RFHmode)
-    mqtt_logger = setup_logging(path.dirname(path.abspath(__file__)), 'custom', 'mqtt', log_level=logging.INFO, mode=1)
+    metrics = Metrics() # Per stage (read, encode, publish, dispatch) per device latency histograms. Published on MQTT_METRICS_TOPIC
+    main_logger = setup_logging(path.dirname(path.abspath(__file__)), main_logger_type, log_level=main_logger_level, mode=RFHmode, use_queue=log_queue)
+    mqtt_logger = setup_logging(path.dirname(path.abspath(__file__)), 'custom', 'mqtt', log_level=logging.INFO, mode=1, use_queue=log_queue)
     
     # MQTT structure: lvl1 = from-to     (ie Pi-2-NodeRed shortened to pi2nred)
     #                 lvl2 = device type (ie servoZCMD, stepperZCMD, adc)
     #                 lvl3 = free form   (ie controls, servo IDs, etc)
     MQTT_CLIENT_ID = 'pi' # Can make ID unique if multiple Pi's could be running similar devices (ie servos, ADC's) 
                           # Node red will need to be linked to unique MQTT_CLIENT_ID
-    mqtt_setup('10.0.0.115') # Pass IP address
+    publish_batch = False # True = devices sharing a lvl2 and publvl3 (same publish topic) are combined into one message per publish tick
+    # Store-and-forward. While disconnected payloads go to a memory-mapped ring file (oldest dropped when full)
+    # and are replayed at replay_rate after reconnect. Set spool = None to drop data while offline
+    spool = Spool(path.join(path.dirname(path.abspath(__file__)), 'spool.dat'), max_bytes=16 * 2**20)
+    replay_rate = 50      # msgs/sec. Live data is published ahead of the backlog
+    # Payload codec. 'json' (default, self describing) or 'struct'|'msgpack'|'cbor' which send only values in data_keys order.
+    # The key order is announced retained on pi2nred/schema/<lvl2>/<publvl3> so Node-RED can rebuild the fields object
+    publish_codec = 'json'
+    # Flow control. At most publish_window messages in flight (QoS1: until PUBACK). While full new data is spooled/held back
+    # and device intervals are stretched (up to 8x) until the window drains. Node-RED can set a device interval at runtime
+    # by publishing seconds to nred2pi/<lvl2>ZCMD/interval
+    publish_qos = 1
+    publish_window = 20
+    credentials = {'user': '', 'password': ''} if args.simulate else {} # Simulated broker needs no ~/stem credentials file
+    mqtt_setup('10.0.0.115', batch=publish_batch, spool=spool, codec=publish_codec, qos=publish_qos, window=publish_window, **credentials) # Pass IP address
     
-    deviceD = {}  # Primary container for storing all devices, topics, and data
+    deviceD = DeviceTable()  # Primary container for storing all devices, topics, and data (device name -> DeviceRecord)
+    printcolor = True
 
     #==== HARDWARE SETUP =====#
-    rotaryEncoderSet = {}
-    rotenc_logger = setup_logging(path.dirname(path.abspath(__file__)), 'custom', 'rotenc', log_level=logging.DEBUG, mode=2)
-
-    device = "rotEnc1"  # Device name should be unique, can not duplicate device ID
-    lvl2 = 'rotencoder' # Topic lvl2 name can be a duplicate, meaning multiple devices publishing data on the same topic
-    publvl3 = MQTT_CLIENT_ID + "" # Will be a tag in influxdb. Optional to modify it and describe experiment being ran
-    data_keys = ['RotEnc1Ci', 'RotEnc1Bi'] # If topic lvl2 name repeats would likely want the data_keys to be unique
-    clkPin, dtPin, button_rotenc = 17, 27, 24
-    setup_device(device, lvl2, publvl3, data_keys)
-    rotaryEncoderSet[device] = rotaryencoder.RotaryEncoder(clkPin, dtPin, button_rotenc, *data_keys, rotenc_logger)
-
-    ina219Set = {}   # ina219 library has an internal logger named ina219. name it something different.
-    ina219_logger = setup_logging(path.dirname(path.abspath(__file__)), 'custom', 'ina219lgr', log_level=logging.DEBUG, mode=1)
-    device = "ina219A"  
-    lvl2 = "ina219A"
-    publvl3 = MQTT_CLIENT_ID + "Test1" # Will be a tag in influxdb. Optional to modify it and describe experiment being ran
-    data_keys = ['Vbusf', 'IbusAf', 'PowerWf']
-    setup_device(device, lvl2, publvl3, data_keys)
-    ina219Set[device] = piina219.PiINA219(*data_keys, gainmode="auto", maxA=0.4, address=0x40, mlogger=ina219_logger)
+    # Devices are listed in the registry file (--devices). Driver modules are imported only for drivers the file uses.
+    # --simulate swaps in the package/sim.py drivers
+    registry = DeviceRegistry.from_file(args.devices, simulate=args.simulate, mlogger=main_logger)
+    interruptSet = {}   # device -> (driver, spec). Read on GPIO edges instead of polling
+    shardspecs = []     # --shards. Polled devices run in worker processes so reads use more than one core (GIL)
+    # Devices on different buses (i2c1, i2c3, spi0) are read in parallel. Devices on the same bus are serialized by a bus lock
+    busreader = BusReader(max_workers=4, mlogger=main_logger, metrics=metrics)
+    busreadtasks = []
+    for spec in registry.devices:
+        device = spec['name']       # Device name should be unique, can not duplicate device ID
+        # lvl2 can be a duplicate (multiple devices publishing on the same topic). publvl3 will be a tag in influxdb
+        setup_device(device, spec['lvl2'], MQTT_CLIENT_ID + spec['publvl3'], spec['data_keys'], interval=spec['interval'],
+                     deadband=spec['deadband'], heartbeat=spec['heartbeat'])
+        log = spec['logger']        # Driver libraries may have internal loggers (ie ina219). Name it something different
+        device_logger = main_logger if log is None else setup_logging(path.dirname(path.abspath(__file__)), 'custom', log['name'],
+                            log_level=getattr(logging, log.get('level', 'INFO')), mode=log.get('mode', 1), use_queue=log_queue)
+        if args.shards and spec['interval'] is not None:
+            shardspecs.append(spec) # Created and read in a shard worker. Readings come back through shared memory
+            continue
+        driver = registry.create(spec, device_logger)
+        if spec['interval'] is None:
+            interruptSet[device] = (driver, spec)
+        else:
+            busreader.add_device(device, spec['bus'], getattr(driver, spec['read']))
+    supervisor = None
+    if shardspecs:
+        from package.shard import ShardSupervisor   # multiprocessing/shared_memory import is only paid for when used
+        supervisor = ShardSupervisor(shardspecs, args.shards, simulate=args.simulate, mlogger=main_logger)
+    # High-rate acquisition: an "mmodule" device with "sampling": {"rate": 1000, "window": 1} samples at kHz into preallocated
+    # buffers and publishes only the window aggregates (see package/registry.py)
 
     print("\n")
     for logger in _loggers:
@@ -319,37 +553,98 @@ def main():
     mqtt_client.on_disconnect = on_disconnect # Bind on disconnect
     mqtt_client.on_message = on_message       # Bind on message
     mqtt_client.on_publish = on_publish       # Bind on publish
-    main_logger.info("Connecting to: {0}".format(MQTT_SERVER))
-    mqtt_client.connect(MQTT_SERVER, 1883)    # Connect to mqtt broker. This is a blocking function. Script will stop while connecting.
-    mqtt_client.loop_start()                  # Start monitoring loop as asynchronous. Starts a new thread and will process incoming/outgoing messages.
-    # Monitor if we're in process of connecting or if the connection failed
-    while not mqtt_client.connected and not mqtt_client.failed_connection:
-        main_logger.info("Waiting")
-        sleep(1)
-    if mqtt_client.failed_connection:         # If connection failed then stop the loop and main program. Use the rc code to trouble shoot
-        mqtt_client.loop_stop()
-        sys.exit()
-    
+    mqtt_publisher.client = mqtt_client
+    # --runtime thread  = paho loop_start() thread + Scheduler in the main thread
+    # --runtime asyncio = one event loop runs the mqtt socket, device tasks and dispatch. I2C/GPIO reads run in an executor
+    #                     (needs a real paho client. Simulated broker has no socket)
+    if args.runtime == 'asyncio':
+        from package.aioruntime import AsyncRuntime     # asyncio import is only paid for when used
+        scheduler = AsyncRuntime(mqtt_client, MQTT_SERVER, 1883, mlogger=main_logger) # Connects (awaitable, with reconnect) inside run()
+        mqtt_cmdqueue.notify = partial(scheduler.call_soon, 'commands') # Handle commands on the event loop instead of a worker thread
+    else:
+        mqtt_cmdqueue.start()
+        main_logger.info("Connecting to: {0}".format(MQTT_SERVER))
+        mqtt_client.connect(MQTT_SERVER, 1883)    # Connect to mqtt broker. This is a blocking function. Script will stop while connecting.
+        mqtt_client.loop_start()                  # Start monitoring loop as asynchronous. Starts a new thread and will process incoming/outgoing messages.
+        # Monitor if we're in process of connecting or if the connection failed
+        while not mqtt_client.connected and not mqtt_client.failed_connection:
+            main_logger.info("Waiting")
+            sleep(1)
+        if mqtt_client.failed_connection:         # If connection failed then stop the loop and main program. Use the rc code to trouble shoot
+            mqtt_client.loop_stop()
+            sys.exit()
+        scheduler = Scheduler(mlogger=main_logger)
+
     #==== MAIN LOOP ====================#
-    # MQTT setup is successful. Initialize dictionaries and start the main loop.   
-    t0_sec = perf_counter() # sec Counter for getting stepper data. Future feature - update interval in  node-red dashboard to link to perf_counter
-    msginterval = 1       # Adjust interval to increase/decrease number of mqtt updates.
+    # Register each device with the scheduler and start the main loop.
+    # Timer devices run on their own interval. Interrupt devices (rotary encoder) run on GPIO edges so the loop sleeps when idle.
+    schedule_bus_reads(scheduler, busreader)   # Polled bus devices (ie ina219)
+    reschedule = partial(scheduler.call_soon, 'reschedule', partial(schedule_bus_reads, scheduler, busreader)) # Thread safe
+    if supervisor is not None:  # Workers read. This process owns the mqtt connection and publishes from the shared table
+        supervisor.start()
+        reschedule = partial(push_shard_intervals, supervisor.table)
+        shardpoll = min(spec['interval'] for spec in shardspecs)
+        scheduler.add_task('shardpublish', shardpoll, partial(publish_shard_reads, supervisor.table, supervisor.devices(), {}))
+        scheduler.add_task('supervisor', 1, supervisor.check)   # Restart crashed workers. mqtt connection is unaffected
+    if mqtt_flow is not None:
+        scheduler.add_task('flowcontrol', 1, stretch_intervals)
+    for device, (driver, spec) in interruptSet.items():
+        read = timed(metrics, 'read', device, getattr(driver, spec['read']))
+        edge_callback = partial(scheduler.call_soon, device, partial(publish_data, device), read=read)
+        for pin in spec['pins']:
+            GPIO.add_event_detect(pin, GPIO.BOTH, callback=lambda channel, cb=edge_callback: cb())
+        if args.simulate and hasattr(driver, 'start'):
+            driver.start()  # Simulated knob turns on its own
+    if publish_batch:
+        publishinterval = 1 # sec. Batched messages go out once per tick
+        scheduler.add_task('publish', publishinterval, mqtt_publisher.flush)
+    statsinterval = 60      # sec. Log jitter/missed deadlines per device and publish/suppressed counts
+    scheduler.add_task('schedstats', statsinterval, lambda: main_logger.info(f"Scheduler stats: {scheduler.stats()}"))
+    scheduler.add_task('pubstats', statsinterval, lambda: main_logger.info(f"Publish stats: {mqtt_publisher.stats()}"))
+    if mqtt_flow is not None:
+        scheduler.add_task('flowstats', statsinterval, lambda: main_logger.info(f"Flow control: {mqtt_flow.stats()}"))
+    scheduler.add_task('busstats', statsinterval, lambda: main_logger.info(f"Late device reads: {busreader.late} Failed: {busreader.failed}"))
+    scheduler.add_task('cmdstats', statsinterval, lambda: main_logger.info(f"Command queue: {mqtt_cmdqueue.stats()}"))
+    if spool is not None:
+        replayer = SpoolReplayer(spool, mqtt_client, rate=replay_rate, period=0.1, flow=mqtt_flow, qos=publish_qos)
+        scheduler.add_task('replay', replayer.period, replayer.step)
+        scheduler.add_task('spoolstats', statsinterval, lambda: main_logger.info(f"Spool stats: {replayer.stats()}"))
+    metricsinterval = 10    # sec. Publish latency histograms (us) and stats as JSON on MQTT_METRICS_TOPIC
+    def publish_metrics():
+        stats = {'stages': metrics.snapshot(), 'scheduler': scheduler.stats(), 'publisher': mqtt_publisher.stats(), 'late': busreader.late,
+                 'failed': busreader.failed, 'commands': mqtt_cmdqueue.stats()}
+        if spool is not None:
+            stats['spool'] = replayer.stats()
+        if mqtt_flow is not None:
+            stats['flow'] = mqtt_flow.stats()
+        if supervisor is not None:
+            stats['shards'] = supervisor.stats()
+        mqtt_client.publish(MQTT_METRICS_TOPIC, json.dumps(stats))
+    scheduler.add_task('metrics', metricsinterval, publish_metrics)
+    main_logger.info(f"Startup took {perf_counter() - T_START:.3f} sec ({len(deviceD)} devices)")
+    profiler = None
+    if args.profile:        # Profiles the thread running the scheduler/event loop (device reads in bus workers are timed by metrics)
+        profiler = ProfileRunner(args.profile_dir, baseline=args.profile_baseline, mlogger=main_logger)
+        scheduler.add_task('profile', args.profile_interval, profiler.dump)
+        profiler.start()
     try:
-        while True:
-            if (perf_counter() - t0_sec) > msginterval: # Get data on a time interval
-                for device, ina219 in ina219Set.items():
-                    deviceD[device]['data'] = ina219.read()
-                    mqtt_client.publish(deviceD[device]['lvl2'].join(MQTT_PUB_LVL1), json.dumps(deviceD[device]['data']))  # publish voltage values
-                t0_sec = perf_counter()
-            for device, rotenc in rotaryEncoderSet.items():
-                deviceD[device]['data'] = rotenc.runencoder()
-                if deviceD[device]['data'] is not None:
-                    mqtt_client.publish(deviceD[device]['lvl2'].join(MQTT_PUB_LVL1), json.dumps(deviceD[device]['data']))
+        scheduler.run()
     except KeyboardInterrupt:
-        main_logger.info(f"{pcolor.WARNING}Exit with ctrl-C{pcolor.ENDC}")
+        main_logger.info(f"{pcolor.YELLOW}Exit with ctrl-C{pcolor.ENDC}")
     finally:
+        if profiler is not None:
+            profiler.dump()
+            profiler.stop()
+        scheduler.stop()
+        mqtt_cmdqueue.stop()
+        busreader.shutdown()
+        if supervisor is not None:
+            supervisor.stop()
         GPIO.cleanup()
         main_logger.info(f"{pcolor.CYAN}GPIO cleaned up{pcolor.ENDC}")
+        if spool is not None:
+            spool.close()
+        stop_log_listener()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,33 +1,250 @@
-import time, logging
+import time, logging, math, threading
+from array import array
+from operator import mul
 from time import perf_counter, perf_counter_ns
-import RPi.GPIO as GPIO
+from .logutil import get_logger
+try:
+    import numpy as np          # Optional. Vectorized aggregation. Falls back to array + builtins
+except ImportError:
+    np = None
+try:
+    from ina219 import DeviceRangeError     # Raised by the ina219 library on current overflow
+except ImportError:
+    class DeviceRangeError(Exception):
+        ''' Current/power overflow (math overflow flag). Same name as the ina219 library exception '''
+try:
+    from smbus2 import SMBus, i2c_msg       # Optional. pip install smbus2. Needed for INA219Burst on the Pi
+except ImportError:
+    SMBus = i2c_msg = None
+
+CNVR, OVF = 0x02, 0x01          # INA219 bus voltage register flags: conversion ready, math overflow
+
+def _signed(raw):
+    return raw - 0x10000 if raw & 0x8000 else raw
+
+class INA219Burst:
+    ''' Register level INA219 on smbus2. registers() reads bus voltage, shunt, current and power in one I2C_RDWR
+        transaction (repeated starts, no stop between registers) instead of one transaction per value.
+        Calibrated so the current register is in current_lsb_ua steps (integer uA, fixed point) '''
+    CONFIG, SHUNT, BUS, POWER, CURRENT, CALIBRATION = 0, 1, 2, 3, 4, 5
+    CONFIG_32V_320MV_12BIT = 0x399F     # 32V bus range, /8 gain, 12 bit bus+shunt ADC, continuous
+
+    def __init__(self, bus=1, address=0x40, shunt_ohms=0.1, max_expected_amps=0.4, config=CONFIG_32V_320MV_12BIT):
+        if SMBus is None:
+            raise ImportError("INA219Burst needs 'pip install smbus2'")
+        self.address = address
+        self.current_lsb_ua = max(1, math.ceil(max_expected_amps * 1e6 / 32768))    # Whole uA so scaling stays integer
+        self.power_lsb_uw = 20 * self.current_lsb_ua
+        self._bus = SMBus(bus)
+        self._write(self.CALIBRATION, int(0.04096 / (self.current_lsb_ua * 1e-6 * shunt_ohms)))
+        self._write(self.CONFIG, config)
+        # Messages are built once and reused. Power is read last because reading it clears conversion ready
+        self._burst = []
+        for register in (self.BUS, self.SHUNT, self.CURRENT, self.POWER):
+            self._burst += [i2c_msg.write(address, [register]), i2c_msg.read(address, 2)]
+        self._poll = [i2c_msg.write(address, [self.BUS]), i2c_msg.read(address, 2)]
+
+    def _write(self, register, value):
+        self._bus.write_i2c_block_data(self.address, register, [value >> 8, value & 0xFF])
+
+    def bus_register(self):
+        ''' One transaction. Raw bus voltage register (poll bit 1 for conversion ready) '''
+        self._bus.i2c_rdwr(*self._poll)
+        return int.from_bytes(bytes(self._poll[1]), 'big')
+
+    def registers(self):
+        ''' One burst transaction. Raw (bus, shunt, current, power) registers '''
+        msgs = self._burst
+        self._bus.i2c_rdwr(*msgs)
+        return tuple(int.from_bytes(bytes(msgs[i]), 'big') for i in (1, 3, 5, 7))
+
+class SampleBuffer:
+    ''' Preallocated fixed size buffer per key. Samples past size overwrite the oldest '''
+
+    def __init__(self, keys, size):
+        self.keys = keys
+        self.size = size
+        if np is not None:
+            self.data = {key: np.zeros(size) for key in keys}
+        else:
+            self.data = {key: array('d', bytes(8 * size)) for key in keys}
+        self._columns = [self.data[key] for key in keys]
+        self.idx = 0            # Next write position
+        self.count = 0          # Samples in buffer (<= size)
+        self.t0 = perf_counter()# Start of window. Used to integrate energy
+
+    def append(self, values):
+        ''' values in the same order as keys '''
+        idx = self.idx
+        for column, value in zip(self._columns, values):
+            column[idx] = value
+        idx += 1
+        self.idx = 0 if idx == self.size else idx
+        if self.count < self.size:
+            self.count += 1
+
+    def window(self, key):
+        ''' Filled part of the buffer for key. Order does not matter for the aggregates '''
+        column = self.data[key]
+        if np is not None:
+            return column[:self.count]
+        return memoryview(column)[:self.count]
+
+    def clear(self):
+        self.idx = 0
+        self.count = 0
+        self.t0 = perf_counter()
+
+def aggregate(values):
+    ''' (min, max, mean, rms) of a window '''
+    n = len(values)
+    if np is not None:
+        return float(values.min()), float(values.max()), float(values.mean()), float(np.sqrt(np.dot(values, values) / n))
+    return min(values), max(values), math.fsum(values) / n, math.sqrt(math.fsum(map(mul, values, values)) / n)
+
+STATS = ('min', 'max', 'mean', 'rms')
+
+def aggregate_keys(key1='Vf', key2='If', energy_key='EJf'):
+    ''' Keys published by device.aggregate() for a device reading key1/key2 '''
+    return [f"{key}_{stat}" for key in (key1, key2) for stat in STATS] + [energy_key]
 
 class device:
+    ''' INA219 voltage/current reads. ina219=None builds an INA219Burst on bus/address (how the registry creates it) '''
 
-    def __init__(self, key1='Vf', key2='If', address=0x40, mlogger=None): 
+    def __init__(self, key1='Vf', key2='If', address=0x40, mlogger=None, ina219=None, energy_key='EJf', burst=None, ready_timeout=0.002,
+                 bus=1, shunt_ohms=0.1, max_expected_amps=0.4):
+        if ina219 is None:
+            ina219 = INA219Burst(bus, address, shunt_ohms=shunt_ohms, max_expected_amps=max_expected_amps)
         self.key1 = key1
         self.key2 = key2
+        self.energy_key = energy_key    # Integrated energy (Joules) key in high-rate aggregate mode
         self.address = address
-        if mlogger is not None:         # Use logger passed as argument
-            self.logger = mlogger
-        elif len(logging.getLogger().handlers) == 0:     # Root logger does not exist and no custom logger passed
-            logging.basicConfig(level=logging.INFO)  # Create root logger
-            self.logger = logging.getLogger(__name__)# Create from root logger
-        else:                                            # Root logger already exists and no custom logger passed
-            self.logger = logging.getLogger(__name__)    # Create from root logger       
+        self.ina219 = ina219            # Sensor driver with voltage() (V) and current() (mA), or registers() (INA219Burst)
+        self.burst = hasattr(ina219, 'registers') if burst is None else burst  # One transaction per read
+        self.ready_timeout = ready_timeout  # sec to poll for a new conversion (12 bit conversion is 532us)
+        self.stale = 0                  # Burst reads that timed out waiting for a new conversion
+        self.outgoing = dict.fromkeys((key1, key2), 0.0)    # Reused every read()
+        self.aggregated = None          # Reused every aggregate(). Only aggregate_keys(), built in start_sampling
+        self._buffers = None            # High-rate mode. Two SampleBuffers, one filling while the other is aggregated
+        self._sampling = False
+        self.logger = get_logger(mlogger, __name__)
         self.logger.info(f'device at {address} setup')
         self.logger.info(self.ina219)
 
+    def _registers(self):
+        ''' Burst read. If the conversion is not ready yet poll the bus register (not fixed settle delays) then read again '''
+        ina219 = self.ina219
+        registers = ina219.registers()
+        if not registers[0] & CNVR:
+            deadline = perf_counter() + self.ready_timeout
+            while not ina219.bus_register() & CNVR:
+                if perf_counter() > deadline:   # Use what we have. Same conversion as the last read
+                    self.stale += 1
+                    return registers
+            registers = ina219.registers()
+        return registers
+
+    def _convert(self, registers):
+        ''' (V, mA) from raw registers with integer (fixed point) scaling. mA rounded to 0.01.
+            mA is None on overflow (OVF only invalidates current and power, the bus voltage is still good) '''
+        bus, shunt, current, power = registers
+        volts = (bus >> 3) * 4 / 1000                                           # 4 mV LSB
+        if bus & OVF:
+            return volts, None
+        centi_ma = (_signed(current) * self.ina219.current_lsb_ua + 5) // 10      # uA -> 0.01 mA, rounded
+        return volts, centi_ma / 100
+
     def read(self):
-        self.outgoing[self.key1] =  self.ina219.voltage()
+        outgoing = self.outgoing
         try:
-            self.outgoing[self.key2] = float("{:.2f}".format(self.ina219.current()))
-        except DeviceRangeError as e:
+            if self.burst:              # Same as the voltage()/current() path: V is updated, I keeps its last value on overflow
+                outgoing[self.key1], milliamps = self._convert(self._registers())
+                if milliamps is None:
+                    raise DeviceRangeError("Current overflow")
+                outgoing[self.key2] = milliamps
+            else:
+                outgoing[self.key1] = self.ina219.voltage()
+                outgoing[self.key2] = round(self.ina219.current(), 2)
+        except DeviceRangeError:
             self.logger.info("Current overflow")
-        self.logger.debug('{0}, {1}, {2}'.format(self.address, self.outgoing.keys(), self.outgoing.values()))
+        if self.logger.isEnabledFor(logging.DEBUG):     # Skip building the message when debug is off
+            self.logger.debug('{0}, {1}, {2}'.format(self.address, self.outgoing.keys(), self.outgoing.values()))
         return self.outgoing
 
+    def aggregate_keys(self):
+        ''' Keys published by aggregate(). Pass as data_keys to setup_device when using high-rate mode '''
+        return aggregate_keys(self.key1, self.key2, self.energy_key)
+
+    def start_sampling(self, rate=1000, window=1):
+        ''' High-rate mode. Sample at rate (Hz) in a background thread into preallocated buffers sized for window (sec) '''
+        size = int(rate * window * 2)   # 2x margin in case aggregate() runs late
+        keys = (self.key1, self.key2)
+        self._buffers = [SampleBuffer(keys, size), SampleBuffer(keys, size)]
+        self.aggregated = dict.fromkeys(self.aggregate_keys(), 0.0)
+        self._stat_keys = {key: tuple(f"{key}_{stat}" for stat in STATS) for key in keys}
+        self._lock = threading.Lock()
+        self._sampling = True
+        self._thread = threading.Thread(target=self._sample_loop, args=(1 / rate,), daemon=True)
+        self._thread.start()
+        self.logger.info(f'device at {self.address} sampling at {rate}Hz')
+
+    def stop_sampling(self):
+        self._sampling = False
+        if self._buffers is not None:
+            self._thread.join()
+
+    def _sample_loop(self, period):
+        if self.burst:                  # One transaction per sample. Sampling paces itself, no conversion ready polling
+            registers, convert = self.ina219.registers, self._convert
+            def sample():
+                volts, milliamps = convert(registers())
+                if milliamps is None:
+                    raise DeviceRangeError("Current overflow")
+                return volts, milliamps
+        else:
+            voltage, current = self.ina219.voltage, self.ina219.current
+            sample = lambda: (voltage(), current())
+        deadline = perf_counter()
+        while self._sampling:
+            try:
+                values = sample()
+            except DeviceRangeError:    # Overflow. Skip the sample
+                values = None
+            if values is not None:
+                with self._lock:
+                    self._buffers[0].append(values)
+            deadline += period
+            delay = deadline - perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -period:       # Fell behind. Resync instead of bursting
+                deadline = perf_counter()
+
+    def aggregate(self):
+        ''' Swap buffers and return min/max/mean/rms per key plus energy (J) integrated over the window.
+            Returns None if no samples arrived since the last call '''
+        with self._lock:
+            buf = self._buffers[0]
+            if buf.count == 0:
+                return None
+            self._buffers.reverse()
+            self._buffers[0].clear()    # Restarts window time for the next aggregate
+        duration = self._buffers[0].t0 - buf.t0
+        outgoing = self.aggregated
+        for key in buf.keys:
+            outgoing.update(zip(self._stat_keys[key], aggregate(buf.window(key))))
+        volts, milliamps = buf.window(self.key1), buf.window(self.key2)
+        if np is not None:
+            power = float(np.dot(volts, milliamps)) / buf.count / 1000
+        else:
+            power = math.fsum(map(mul, volts, milliamps)) / buf.count / 1000
+        outgoing[self.energy_key] = power * duration    # mean W * sec
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('{0}, {1} samples, {2}'.format(self.address, buf.count, outgoing))
+        return outgoing
+
     def cleanupGPIO(self):
+        import RPi.GPIO as GPIO         # Imported here so the module loads without RPi.GPIO (only cleanup uses it)
         GPIO.cleanup()
 
 if __name__ == "__main__":
@@ -74,17 +291,22 @@ if __name__ == "__main__":
     payload_keys = ['Vbusf', 'IbusAf', 'PowerWf']
     ina219A = PiINA219(*payload_keys, "auto", 0.4, 0x40, mlogger=main_logger, mlog_level=main_log_level)
     ina219B = PiINA219(*payload_keys, "auto", 0.4, 0x41, mlogger=main_logger, mlog_level=main_log_level)
+    from package.instrument import Histogram
+    read_hist = Histogram()          # read() latency in ns
     #while True:
     for i in range(5):
         t0 = perf_counter_ns()
         reading = ina219A.read()
-        tdelta = perf_counter_ns() - t0
+        read_hist.record(perf_counter_ns() - t0)
         #logging.info('{0} {1}'.format(reading.keys(), reading.values()))
         time.sleep(1)
+    main_logger.info(f'read() awake latency us: {read_hist.as_dict()}')
     ina219A.sleep()
+    read_hist.reset()
     for i in range(5):
         t0 = perf_counter_ns()
         reading = ina219A.read()
-        tdelta = perf_counter_ns() - t0
+        read_hist.record(perf_counter_ns() - t0)
         #logging.info('{0} {1}'.format(reading.keys(), reading.values()))
-        time.sleep(1)
\ No newline at end of file
+        time.sleep(1)
+    main_logger.info(f'read() asleep latency us: {read_hist.as_dict()}')
\ No newline at end of file
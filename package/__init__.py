@@ -1 +1,9 @@
-from .Mmodule import device
+def __getattr__(name):
+    ''' Lazy exports. Importing a package submodule (ie package.sim) does not pull in Mmodule (RPi.GPIO, numpy) '''
+    if name == 'device':
+        from .Mmodule import device
+        return device
+    if name == 'Scheduler':
+        from .scheduler import Scheduler
+        return Scheduler
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
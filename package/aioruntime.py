@@ -0,0 +1,230 @@
+import asyncio, threading, time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from .scheduler import TaskStats
+from .logutil import get_logger
+
+class _AioTask:
+    __slots__ = ('name', 'interval', 'callback', 'read', 'start_delay', 'stats', 'handle')
+
+    def __init__(self, name, interval, callback, read, start_delay):
+        self.name = name
+        self.interval = interval
+        self.callback = callback
+        self.read = read
+        self.start_delay = start_delay
+        self.stats = TaskStats()
+        self.handle = None          # asyncio.Task once running
+
+class AsyncRuntime:
+    ''' asyncio alternative to Scheduler + paho loop_start(). One event loop drives the mqtt socket (add_reader/add_writer),
+        device tasks, publish and on_message dispatch. Blocking hardware reads run in a small executor.
+        Same add_task/call_soon/set_interval/stats/run/stop interface as Scheduler '''
+
+    def __init__(self, client, host, port=1883, keepalive=60, hw_workers=1, mlogger=None):
+        self.client = client
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self._hw = ThreadPoolExecutor(max_workers=hw_workers, thread_name_prefix='hw') # 1 worker keeps bus access serialized
+        self._tasks = {}
+        self.loop = None
+        self._early = deque(maxlen=1000)    # Edges from call_soon before the loop runs. Replayed once it starts
+        self._early_lock = threading.Lock()
+        self._loop_thread = None
+        self._connected = None      # asyncio.Event set while connected
+        self._connack = None        # asyncio.Event set on every CONNACK (success or failure)
+        self._stopping = None
+        self._reconnecting = None
+        self.logger = get_logger(mlogger, __name__)
+
+    #==== Scheduler interface ====#
+    def add_task(self, name, interval, callback, start_delay=None, read=None):
+        ''' Run callback every interval (sec). If read is given it runs in the hardware executor and callback(data) runs on the loop '''
+        if interval <= 0:
+            raise ValueError(f"Interval for {name} must be > 0")
+        old = self._tasks.get(name)
+        task = self._tasks[name] = _AioTask(name, interval, callback, read, interval if start_delay is None else start_delay)
+        if old is not None:
+            task.stats = old.stats
+        if self.loop is not None:
+            self._call(self._start, task, old)
+
+    def set_interval(self, name, interval):
+        task = self._tasks[name]
+        self.add_task(name, interval, task.callback, read=task.read)
+
+    def get_interval(self, name):
+        return self._tasks[name].interval
+
+    def remove_task(self, name):
+        task = self._tasks.pop(name, None)
+        if task is not None and task.handle is not None:
+            self._call(task.handle.cancel)
+
+    def call_soon(self, name, callback, read=None):
+        ''' Thread safe. Used from GPIO interrupt callbacks. Edges before run() are queued (oldest dropped past 1000) '''
+        if self.loop is None:
+            with self._early_lock:
+                if self.loop is None:
+                    self._early.append((name, callback, read, time.monotonic()))   # loop.time() is time.monotonic()
+                    return
+        self.loop.call_soon_threadsafe(self._edge, name, callback, read, self.loop.time())
+
+    def stats(self):
+        return {name: task.stats.as_dict() for name, task in self._tasks.items()}
+
+    def run(self):
+        ''' Blocking. Connect, start device tasks and run until stop() '''
+        asyncio.run(self.main())
+
+    def stop(self):
+        if self.loop is not None and not self.loop.is_closed():
+            self._call(self._stopping.set)
+
+    #==== Tasks ====#
+    def _call(self, fn, *args):
+        ''' Run fn on the loop thread. Direct if already there '''
+        if threading.get_ident() == self._loop_thread:
+            fn(*args)
+        else:
+            self.loop.call_soon_threadsafe(fn, *args)
+
+    def _start(self, task, old=None):
+        if old is not None and old.handle is not None:
+            old.handle.cancel()
+        task.handle = self.loop.create_task(self._periodic(task))
+
+    async def _run_task(self, name, callback, read):
+        try:
+            if read is not None:
+                callback(await self.loop.run_in_executor(self._hw, read))
+            else:
+                callback()
+        except Exception:
+            self.logger.exception(f"Task {name} failed")
+
+    async def _periodic(self, task):
+        loop = self.loop
+        deadline = loop.time() + task.start_delay
+        while True:
+            delay = deadline - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            lateness = loop.time() - deadline
+            if lateness >= task.interval:   # Fell behind. Skip missed periods
+                missed = int(lateness // task.interval)
+                task.stats.missed += missed
+                deadline += missed * task.interval
+            deadline += task.interval
+            task.stats.runs += 1
+            task.stats.update(lateness)
+            await self._run_task(task.name, task.callback, task.read)
+
+    def _edge(self, name, callback, read, t_event):
+        task = self._tasks.get(name)
+        if task is None:                # Edge only device. Track stats without scheduling it
+            task = self._tasks[name] = _AioTask(name, None, callback, read, 0)
+        task.stats.edges += 1
+        task.stats.update(self.loop.time() - t_event)
+        self.loop.create_task(self._run_task(name, callback, read))
+
+    #==== MQTT socket on the event loop ====#
+    def _on_socket_open(self, client, userdata, sock):
+        self._call(self.loop.add_reader, sock, client.loop_read)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._call(self.loop.remove_reader, sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._call(self.loop.add_writer, sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._call(self.loop.remove_writer, sock)
+
+    async def _misc_loop(self):
+        ''' Keepalive pings and retries. Replaces what the loop_start() thread did '''
+        while True:
+            self.client.loop_misc()
+            await asyncio.sleep(1)
+
+    def _bind(self):
+        client = self.client
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+        user_on_connect, user_on_disconnect = client.on_connect, client.on_disconnect
+
+        def on_connect(client, userdata, flags, rc):
+            if user_on_connect is not None:
+                user_on_connect(client, userdata, flags, rc)
+            if rc == 0:
+                self._connected.set()
+            self._connack.set()
+
+        def on_disconnect(client, userdata, rc=0):
+            self._connected.clear()
+            if user_on_disconnect is not None:
+                user_on_disconnect(client, userdata, rc)
+            if rc != 0 and not self._stopping.is_set() and self._reconnecting is None:
+                self._reconnecting = self.loop.create_task(self.reconnect())
+
+        client.on_connect = on_connect
+        client.on_disconnect = on_disconnect
+
+    async def connect(self, timeout=None):
+        ''' Connect and wait for CONNACK. Returns True if the broker accepted the connection '''
+        self._connack.clear()
+        # connect() does a blocking TCP connect. Run it off the loop. Socket callbacks are marshalled back with _call
+        await self.loop.run_in_executor(None, self.client.connect, self.host, self.port, self.keepalive)
+        await asyncio.wait_for(self._connack.wait(), timeout)
+        return self._connected.is_set()
+
+    async def wait_connected(self, timeout=None):
+        await asyncio.wait_for(self._connected.wait(), timeout)
+
+    async def reconnect(self, max_delay=60):
+        ''' Retry with backoff until connected '''
+        delay = 1
+        try:
+            while not self._connected.is_set() and not self._stopping.is_set():
+                try:
+                    self._connack.clear()
+                    await self.loop.run_in_executor(None, self.client.reconnect)
+                    await asyncio.wait_for(self._connack.wait(), 10)
+                except (OSError, asyncio.TimeoutError) as e:
+                    self.logger.info(f"Reconnect failed ({e}). Retry in {delay} sec")
+                if not self._connected.is_set():
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, max_delay)
+        finally:
+            self._reconnecting = None
+
+    async def main(self):
+        self._loop_thread = threading.get_ident()
+        self._connected, self._connack, self._stopping = asyncio.Event(), asyncio.Event(), asyncio.Event()
+        with self._early_lock:
+            self.loop = asyncio.get_running_loop()
+            early, self._early = list(self._early), deque(maxlen=self._early.maxlen)
+        if early:
+            self.logger.info(f"Running {len(early)} GPIO edges queued before the loop started")
+        for edge in early:
+            self._edge(*edge)
+        self._bind()
+        self.logger.info("Connecting to: {0}".format(self.host))
+        if not await self.connect():
+            raise SystemExit("Unsuccessful mqtt connection")
+        misc = self.loop.create_task(self._misc_loop())
+        for task in self._tasks.values():
+            if task.interval is not None:
+                self._start(task)
+        try:
+            await self._stopping.wait()
+        finally:
+            for task in self._tasks.values():
+                if task.handle is not None:
+                    task.handle.cancel()
+            misc.cancel()
+            self.client.disconnect()
+            self._hw.shutdown(wait=False)
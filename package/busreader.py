@@ -0,0 +1,74 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from time import perf_counter, perf_counter_ns
+from .logutil import get_logger
+
+class BusReader:
+    ''' Read devices grouped by bus (ie 'i2c1', 'i2c3', 'spi0'). Different buses are read concurrently in a thread pool.
+        A lock per bus keeps transactions on the same bus serialized. read() returns at a deadline and flags
+        devices that did not finish instead of letting one slow bus stall the whole tick '''
+
+    def __init__(self, max_workers=4, mlogger=None, metrics=None):
+        self.metrics = metrics      # Optional instrument.Metrics. Records 'read' time per device
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='bus')
+        self._bus = {}          # device -> bus
+        self._read = {}         # device -> read function
+        self._locks = {}        # bus -> Lock
+        self.late = {}          # device -> ticks the device missed the deadline
+        self.failed = {}        # device -> reads that raised
+        self.logger = get_logger(mlogger, __name__)
+
+    def add_device(self, device, bus, read):
+        self._bus[device] = bus
+        self._read[device] = read
+        self._locks.setdefault(bus, threading.Lock())
+        self.late[device] = 0
+        self.failed[device] = 0
+
+    def devices(self):
+        return list(self._bus)
+
+    def bus_lock(self, bus):
+        ''' Lock for a bus. Hold it for any other transaction on the bus (ie config writes from a command handler) '''
+        return self._locks[bus]
+
+    def _read_bus(self, bus, devices, results, failed, t_end):
+        lock = self._locks[bus]
+        if not lock.acquire(timeout=max(t_end - perf_counter(), 0)):  # Previous tick still on this bus
+            return
+        try:
+            metrics = self.metrics
+            for device in devices:
+                if perf_counter() > t_end:  # Out of time. Leave the rest for the next tick
+                    return
+                try:
+                    t0 = perf_counter_ns()
+                    results[device] = self._read[device]()
+                    if metrics is not None:
+                        metrics.record('read', device, perf_counter_ns() - t0)
+                except Exception:
+                    failed.append(device)
+                    self.logger.exception(f"{device} read failed on {bus}")
+        finally:
+            lock.release()
+
+    def read(self, devices, timeout):
+        ''' Read devices with buses in parallel. Returns ({device: data}, [late devices], [failed devices]) after at most timeout sec '''
+        by_bus = {}
+        for device in devices:
+            by_bus.setdefault(self._bus[device], []).append(device)
+        results, failed = {}, []
+        t_end = perf_counter() + timeout
+        futures = [self._pool.submit(self._read_bus, bus, group, results, failed, t_end) for bus, group in by_bus.items()]
+        wait(futures, timeout)
+        results = dict(results)         # Snapshot. A straggler may still write into the original
+        failed = set(failed)
+        late = [device for device in devices if device not in results and device not in failed]
+        for device in late:
+            self.late[device] += 1
+        for device in failed:
+            self.failed[device] += 1
+        return results, late, list(failed)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
@@ -0,0 +1,116 @@
+import threading
+from collections import deque
+from .topicrouter import TopicRouter
+from .logutil import get_logger
+
+class CommandQueue:
+    ''' Moves inbound command handling off the paho network thread.
+        put() stores the raw payload per topic. A newer command for a topic that is still pending replaces it (latest wins),
+        so a burst of dashboard slider moves applies only the last position.
+        Priority topics (ie nred2pi/+/stop) drop the pending commands for the same lvl2, so a queued move never runs after
+        a stop, and go in an urgent slot that is handled before anything pending (right after the handler running now).
+        Commands are handled one at a time by a worker thread (start()) or, if notify is set, by whoever notify hands
+        drain() to (ie AsyncRuntime.call_soon so handlers run on the event loop) '''
+
+    def __init__(self, handler, priority=(), notify=None, mlogger=None):
+        self.handler = handler          # handler(topic, payload) decodes and dispatches
+        self.notify = notify            # notify(drain). Used instead of the worker thread
+        self._priority = TopicRouter()
+        for pattern in priority:
+            self._priority.add(pattern, True)
+        self._pending = {}              # topic -> payload. Insertion ordered so topics are served first come first served
+        self._urgent = deque()          # (topic, payload) of priority commands. Served before _pending
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+        self.counters = {'handled': 0, 'coalesced': 0, 'priority': 0, 'cancelled': 0}
+        self.logger = get_logger(mlogger, __name__)
+
+    def put(self, topic, payload):
+        ''' Called from on_message. Never waits for a handler so paho can get back to the socket/keepalive '''
+        priority = bool(self._priority.match(topic))
+        with self._cond:
+            if priority:
+                self.counters['priority'] += 1
+                self._cancel(topic.split('/')[1])
+                self._urgent.append((topic, payload))
+                was_empty = True
+            else:
+                if topic in self._pending:
+                    self.counters['coalesced'] += 1     # Stale command dropped
+                was_empty = not self._pending and not self._urgent
+                self._pending[topic] = payload
+            self._cond.notify()
+        if was_empty and self.notify is not None:
+            self.notify(self.drain)
+
+    def _cancel(self, lvl2):
+        stale = [topic for topic in self._pending if topic.split('/', 2)[1:2] == [lvl2]]
+        for topic in stale:
+            del self._pending[topic]
+        if stale:
+            self.counters['cancelled'] += len(stale)
+            self.logger.info(f"Dropped {len(stale)} pending commands for {lvl2}")
+        return len(stale)
+
+    def cancel(self, lvl2):
+        ''' Drop pending commands whose topic lvl2 is lvl2. Returns number dropped '''
+        with self._cond:
+            return self._cancel(lvl2)
+
+    def _pop(self):
+        if self._urgent:
+            return self._urgent.popleft()
+        topic = next(iter(self._pending))
+        return topic, self._pending.pop(topic)
+
+    def _next(self):
+        ''' Pop and handle one command, urgent first. False if there was none '''
+        with self._cond:
+            if not self._urgent and not self._pending:
+                return False
+            topic, payload = self._pop()
+        self._handle(topic, payload)
+        return True
+
+    def drain(self):
+        ''' Handle everything pending. Returns number handled '''
+        handled = 0
+        while self._next():
+            handled += 1
+        return handled
+
+    def _handle(self, topic, payload):
+        try:
+            self.handler(topic, payload)
+        except Exception:
+            self.logger.exception(f"Command on {topic} failed")
+        self.counters['handled'] += 1
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while self._running and not self._pending and not self._urgent:
+                    self._cond.wait()
+                if not self._running:
+                    return
+            self._next()
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._worker, name='commands', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    @property
+    def depth(self):
+        return len(self._pending) + len(self._urgent)
+
+    def stats(self):
+        return dict(self.counters, depth=self.depth)
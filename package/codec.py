@@ -0,0 +1,96 @@
+import json, struct
+try:
+    import msgpack              # Optional. pip install msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2                # Optional. pip install cbor2
+except ImportError:
+    cbor2 = None
+
+class Schema:
+    ''' Ordered data keys for a publish topic. Binary codecs send only the values in this order.
+        The schema is announced once (retained) so Node-RED can rebuild {key: value} '''
+
+    def __init__(self, keys):
+        self.keys = tuple(keys)
+        self.packer = struct.Struct('<' + 'd' * len(self.keys))   # Used by StructCodec
+
+    def values(self, data):
+        ''' Values in schema order. Missing keys are sent as None (NaN for struct) '''
+        get = data.get
+        return [get(key) for key in self.keys]
+
+    def announcement(self, codec):
+        return json.dumps({'codec': codec.name, 'keys': self.keys,
+                           'format': self.packer.format if codec.name == 'struct' else None})
+
+class JsonCodec:
+    ''' Default. Self describing {key: value} payload (same as json.dumps/json.loads) '''
+    name = 'json'
+    binary = False
+
+    def encode(self, schema, data):
+        return json.dumps(data)
+
+    def decode(self, payload, schema=None):
+        return json.loads(payload.decode("utf-8", "ignore") if isinstance(payload, (bytes, bytearray)) else payload)
+
+class StructCodec:
+    ''' Little endian float64 per schema key. Smallest/fastest for numeric data. Not self describing, needs the schema '''
+    name = 'struct'
+    binary = True
+
+    def encode(self, schema, data):
+        nan = float('nan')
+        return schema.packer.pack(*[nan if value is None else value for value in schema.values(data)])
+
+    def decode(self, payload, schema=None):
+        if schema is None:
+            raise ValueError("struct payloads need a schema to decode")
+        return dict(zip(schema.keys, schema.packer.unpack(payload)))
+
+class MsgpackCodec:
+    ''' msgpack array of values in schema order. Self describing types so inbound commands can use it without a schema '''
+    name = 'msgpack'
+    binary = True
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError("msgpack codec needs 'pip install msgpack'")
+
+    def encode(self, schema, data):
+        return msgpack.packb(schema.values(data))
+
+    def decode(self, payload, schema=None):
+        obj = msgpack.unpackb(payload)
+        if schema is not None and isinstance(obj, list):
+            return dict(zip(schema.keys, obj))
+        return obj
+
+class CborCodec:
+    ''' CBOR array of values in schema order '''
+    name = 'cbor'
+    binary = True
+
+    def __init__(self):
+        if cbor2 is None:
+            raise ImportError("cbor codec needs 'pip install cbor2'")
+
+    def encode(self, schema, data):
+        return cbor2.dumps(schema.values(data))
+
+    def decode(self, payload, schema=None):
+        obj = cbor2.loads(payload)
+        if schema is not None and isinstance(obj, list):
+            return dict(zip(schema.keys, obj))
+        return obj
+
+CODECS = {'json': JsonCodec, 'struct': StructCodec, 'msgpack': MsgpackCodec, 'cbor': CborCodec}
+
+def get_codec(name):
+    ''' Codec instance by name: json, struct, msgpack, cbor '''
+    try:
+        return CODECS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown codec {name}. Options: {', '.join(CODECS)}") from None
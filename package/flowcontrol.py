@@ -0,0 +1,89 @@
+import threading
+from time import perf_counter
+from .logutil import get_logger
+
+class FlowControl:
+    ''' Bounded in-flight window for publishes. Publisher calls sent(mid) after client.publish and on_publish calls acked(mid).
+        With QoS1 a mid is in flight until the broker PUBACKs it, with QoS0 until paho has written it to the socket,
+        so the window also bounds paho's internal outgoing queue.
+        While full, Publisher holds new data back (spooled, or latest value kept) instead of handing it to paho.
+        update() is called periodically and returns a stretch factor for device intervals: doubled while congested
+        (window above high or full since the last update), halved back toward 1 once below low '''
+
+    def __init__(self, window=20, high=0.75, low=0.25, max_stretch=8, mlogger=None):
+        self.window = window
+        self.high = high                # Fraction of window. Congested above this
+        self.low = low                  # Fraction of window. Relax below this
+        self.max_stretch = max_stretch
+        self.stretch = 1                # Multiplier applied to device intervals
+        self._inflight = {}             # mid -> perf_counter() when published
+        self._early = set()             # Acks that arrived before sent() (paho can call on_publish before publish returns)
+        self._lock = threading.Lock()
+        self._peak = 0                  # Most in flight since last update
+        self._blocked = 0               # Publishes held back since last update
+        self.counters = {'sent': 0, 'acked': 0, 'blocked': 0, 'ack_max_ms': 0.0}
+        self.logger = get_logger(mlogger, __name__)
+
+    @property
+    def inflight(self):
+        return len(self._inflight)
+
+    @property
+    def full(self):
+        return len(self._inflight) >= self.window
+
+    def block(self):
+        ''' Publisher held a message back because the window was full '''
+        self._blocked += 1
+        self.counters['blocked'] += 1
+
+    def sent(self, mid):
+        with self._lock:
+            self.counters['sent'] += 1
+            if mid in self._early:
+                self._early.discard(mid)
+                self.counters['acked'] += 1
+                return
+            self._inflight[mid] = perf_counter()
+            if len(self._inflight) > self._peak:
+                self._peak = len(self._inflight)
+
+    def acked(self, mid):
+        ''' Call from on_publish '''
+        with self._lock:
+            t_sent = self._inflight.pop(mid, None)
+            if t_sent is None:
+                self._early.add(mid)    # Not ours yet (or not tracked, ie schema announcements). Bounded below
+                if len(self._early) > self.window * 4:
+                    self._early.clear()
+                return
+            self.counters['acked'] += 1
+            ack_ms = (perf_counter() - t_sent) * 1000
+            if ack_ms > self.counters['ack_max_ms']:
+                self.counters['ack_max_ms'] = round(ack_ms, 3)
+
+    def clear(self):
+        ''' Forget everything in flight. For QoS0 after a disconnect (paho drops unsent QoS0 messages without on_publish).
+            Do not use for QoS1, paho resends those on reconnect and they are acked under the same mid '''
+        with self._lock:
+            self._inflight.clear()
+            self._early.clear()
+
+    def update(self):
+        ''' Returns the new stretch factor if it changed, else None '''
+        with self._lock:
+            peak, blocked = max(self._peak, len(self._inflight)), self._blocked
+            self._peak, self._blocked = len(self._inflight), 0
+        stretch = self.stretch
+        if blocked or peak > self.high * self.window:
+            stretch = min(stretch * 2, self.max_stretch)
+        elif peak < self.low * self.window:
+            stretch = max(stretch // 2, 1)
+        if stretch == self.stretch:
+            return None
+        self.logger.info(f"Publish window {peak}/{self.window} ({blocked} held back). Device intervals x{stretch}")
+        self.stretch = stretch
+        return stretch
+
+    def stats(self):
+        return dict(self.counters, inflight=self.inflight, stretch=self.stretch)
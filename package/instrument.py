@@ -0,0 +1,156 @@
+import cProfile, os, pstats
+from array import array
+from time import perf_counter_ns, strftime
+from .logutil import get_logger
+
+class Histogram:
+    ''' HDR style latency histogram. Log-linear buckets: 2**SUB_BITS buckets per power of two (~6% resolution)
+        Fixed memory, O(1) record. Values are integers (ns) '''
+
+    SUB_BITS = 4
+    SUB = 1 << SUB_BITS
+
+    def __init__(self, max_value=60 * 10**9):
+        self._size = (max_value.bit_length() + 1) << self.SUB_BITS
+        self.counts = array('Q', bytes(8 * self._size))
+        self.reset()
+
+    def reset(self):
+        for i in range(self._size):
+            self.counts[i] = 0
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def _index(self, value):
+        if value < self.SUB:
+            return value
+        shift = value.bit_length() - self.SUB_BITS - 1
+        return min(((shift + 1) << self.SUB_BITS) + (value >> shift) - self.SUB, self._size - 1)
+
+    def _value(self, index):
+        ''' Lowest value in bucket '''
+        if index < self.SUB:
+            return index
+        shift = (index >> self.SUB_BITS) - 1
+        return (self.SUB + (index & (self.SUB - 1))) << shift
+
+    def record(self, value):
+        self.counts[self._index(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        if self.min is None or value < self.min:
+            self.min = value
+
+    def percentile(self, p):
+        if not self.count:
+            return 0
+        target = max(1, int(self.count * p / 100 + 0.5))
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                if index == self._size - 1:     # Overflow bucket (values above max_value are clamped into it)
+                    return self.max
+                return min(self._value(index), self.max)
+        return self.max
+
+    def as_dict(self, scale=1000):
+        ''' Summary in us (scale=1000 for ns values) '''
+        if not self.count:
+            return {'count': 0}
+        return {'count': self.count, 'min': round(self.min / scale, 1), 'mean': round(self.total / self.count / scale, 1),
+                'p50': round(self.percentile(50) / scale, 1), 'p90': round(self.percentile(90) / scale, 1),
+                'p99': round(self.percentile(99) / scale, 1), 'max': round(self.max / scale, 1)}
+
+class Metrics:
+    ''' Per stage, per device latency histograms. Hot paths time themselves with perf_counter_ns and call record()
+        Stages used: read, encode, publish, dispatch '''
+
+    def __init__(self):
+        self._hist = {}         # stage -> {device: Histogram}. Nested so record() does not build a key tuple per call
+
+    def record(self, stage, device, ns):
+        devices = self._hist.get(stage)
+        if devices is None:
+            devices = self._hist[stage] = {}
+        hist = devices.get(device)
+        if hist is None:
+            hist = devices[device] = Histogram()
+        hist.record(ns)
+
+    def histogram(self, stage, device):
+        return self._hist.get(stage, {}).get(device)
+
+    def snapshot(self, reset=True):
+        ''' {stage: {device: {count, min, mean, p50, p90, p99, max}}} in us. Reset starts a new window '''
+        out = {}
+        for stage, devices in list(self._hist.items()):
+            out[stage] = summary = {}
+            for device, hist in list(devices.items()):
+                summary[device] = hist.as_dict()
+                if reset:
+                    hist.reset()
+        return out
+
+def timed(metrics, stage, device, fn):
+    ''' Wrap fn so each call is recorded in metrics '''
+    def wrapper(*args, **kwargs):
+        t0 = perf_counter_ns()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            metrics.record(stage, device, perf_counter_ns() - t0)
+    return wrapper
+
+class ProfileRunner:
+    ''' cProfile the calling thread. dump() writes a .prof file and optionally logs the top changes vs a saved baseline
+        View dumps with python3 -m pstats <file> or pyprof2calltree (see README) '''
+
+    def __init__(self, profile_dir, baseline=None, top=10, mlogger=None):
+        self.profile_dir = profile_dir
+        self.baseline = baseline    # .prof file to diff against
+        self.top = top
+        self._profile = cProfile.Profile()
+        self._dumps = 0
+        os.makedirs(profile_dir, exist_ok=True)
+        self.logger = get_logger(mlogger, __name__)
+
+    def start(self):
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+
+    def dump(self):
+        ''' Write cumulative profile to profile_dir/profile-<time>-<n>.prof. Returns the filename '''
+        self._dumps += 1
+        filename = os.path.join(self.profile_dir, strftime("profile-%Y%m%d-%H%M%S") + f"-{self._dumps}.prof")
+        self._profile.disable()
+        self._profile.dump_stats(filename)
+        self._profile.enable()
+        self.logger.info(f"Profile written to {filename}")
+        if self.baseline is not None:
+            for line in self.diff(filename, self.baseline, self.top):
+                self.logger.info(line)
+        return filename
+
+    @staticmethod
+    def diff(current, baseline, top=10):
+        ''' Lines describing the functions whose tottime per call changed most vs baseline '''
+        def per_call(filename):
+            stats = pstats.Stats(filename).stats
+            return {func: (tt / nc if nc else 0.0, nc) for func, (cc, nc, tt, ct, callers) in stats.items()}
+        now, base = per_call(current), per_call(baseline)
+        changes = []
+        for func, (tt, nc) in now.items():
+            base_tt = base.get(func, (0.0, 0))[0]
+            changes.append((tt - base_tt, func, tt, base_tt, nc))
+        changes.sort(key=lambda change: abs(change[0]), reverse=True)
+        lines = [f"Profile diff vs {baseline} (tottime per call, us)"]
+        for delta, (filename, lineno, name), tt, base_tt, nc in changes[:top]:
+            lines.append(f"  {delta * 1e6:+10.2f}  {base_tt * 1e6:10.2f} -> {tt * 1e6:10.2f}  calls {nc:<8} {name} {os.path.basename(filename)}:{lineno}")
+        return lines
@@ -0,0 +1,6 @@
+import logging
+
+def get_logger(mlogger=None, name=__name__):
+    ''' Logger for a package class. mlogger (passed by the application, ie from setup_logging) if given, else logging.getLogger(name).
+        Does not configure the root logger. That is up to the application. Unconfigured, python still prints warnings and errors '''
+    return mlogger if mlogger is not None else logging.getLogger(name)
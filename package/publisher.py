@@ -0,0 +1,162 @@
+import sys
+from time import perf_counter_ns
+from .codec import JsonCodec, Schema
+from .logutil import get_logger
+
+class _Stream:
+    ''' Publish state for one device '''
+    __slots__ = ('device', 'topic', 'topic_b', 'lvl2', 'schema', 'schema_topic', 'deadband', 'heartbeat', 'last', 'skipped', 'last_size')
+
+    def __init__(self, device, topic, lvl2, schema, schema_topic, deadband, heartbeat):
+        self.device = device
+        self.topic = sys.intern(topic)
+        self.topic_b = topic.encode()   # Spooled as bytes. Built once instead of per message
+        self.lvl2 = lvl2
+        self.schema = schema
+        self.schema_topic = schema_topic
+        self.deadband = deadband    # {key: (limit, percent)}
+        self.heartbeat = heartbeat  # Force a publish after this many suppressed intervals. 0 = never
+        self.last = None            # Last published data
+        self.skipped = 0            # Intervals suppressed since last publish
+        self.last_size = 0          # bytes of last published payload. Used to estimate suppressed bytes
+
+class Publisher:
+    ''' Pipeline stage between deviceD and the mqtt client.
+        Suppresses data that has not moved outside a per key deadband, forces a heartbeat every N intervals
+        and optionally batches all devices sharing a publish topic (lvl2 and publvl3) into one message per flush.
+        Batches are keyed by the full topic, not lvl2 alone, so devices on one lvl2 with different publvl3 (influx tags) stay apart.
+        Payloads are encoded by codec (package.codec). The key schema of each topic is announced retained on its schema topic.
+        With flow (package.flowcontrol.FlowControl) nothing new is handed to the client while the in-flight window is full:
+        it goes to the spool, or without a spool the device's latest data is offered again on its next interval '''
+
+    def __init__(self, client=None, batch=False, mlogger=None, spool=None, codec=None, metrics=None, flow=None, qos=0):
+        self.client = client        # mqtt client. Can be set after devices are added
+        self.metrics = metrics      # Optional instrument.Metrics. Records 'encode' and 'publish' time per device (per topic when batched)
+        self.batch = batch
+        self.codec = codec if codec is not None else JsonCodec()
+        self.spool = spool          # Optional Spool. Messages are stored there while the client is disconnected
+        self.flow = flow            # Optional FlowControl. Bounds messages in flight (mids not yet acked in on_publish)
+        self.qos = qos
+        self._streams = {}
+        self._pending = {}          # topic -> {device: data} waiting for flush (batch mode)
+        self._batchtopic = {}       # topic -> (schema_topic, topic bytes) for batched messages
+        self._batchkeys = {}        # topic -> keys of every device publishing on that topic
+        self._batchschema = {}
+        self.counters = {'sent': 0, 'sent_bytes': 0, 'suppressed': 0, 'suppressed_bytes': 0, 'spooled': 0}
+        self.logger = get_logger(mlogger, __name__)
+
+    def add_device(self, device, topic, lvl2, keys=(), deadband=None, heartbeat=0, schema_topic=None):
+        ''' keys are the data_keys (payload schema). schema_topic is where the schema is announced
+            deadband = {key: limit}. limit is absolute (0.05) or percent of last published value ('2%').
+            Keys without a deadband publish on any change '''
+        limits = {}
+        for key, limit in (deadband or {}).items():
+            if isinstance(limit, str) and limit.endswith('%'):
+                limits[key] = (float(limit[:-1]) / 100, True)
+            else:
+                limits[key] = (float(limit), False)
+        self._streams[device] = _Stream(device, topic, lvl2, Schema(keys), schema_topic, limits, heartbeat)
+        self._batchtopic.setdefault(topic, (schema_topic, topic.encode()))
+        batchkeys = self._batchkeys.setdefault(topic, [])
+        batchkeys.extend(key for key in keys if key not in batchkeys)
+        self._batchschema[topic] = Schema(batchkeys)
+
+    def announce(self):
+        ''' Publish (retained) the codec and key order for every topic. Call from on_connect '''
+        if self.batch:
+            schemas = [(self._batchtopic[topic][0], schema) for topic, schema in self._batchschema.items()]
+        else:
+            schemas = [(stream.schema_topic, stream.schema) for stream in self._streams.values()]
+        for schema_topic, schema in schemas:
+            if schema_topic is not None:
+                self.client.publish(schema_topic, schema.announcement(self.codec), qos=1, retain=True)
+
+    def _changed(self, stream, data):
+        last = stream.last
+        if last is None or last.keys() != data.keys():
+            return True
+        deadband = stream.deadband
+        for key, value in data.items():
+            prev = last[key]
+            if value == prev:
+                continue
+            limit = deadband.get(key)
+            if limit is None:
+                return True
+            try:
+                delta = abs(value - prev)
+            except TypeError:           # Non numeric value changed
+                return True
+            if delta > (limit[0] * abs(prev) if limit[1] else limit[0]):
+                return True
+        return False
+
+    def submit(self, device, data):
+        ''' Offer new device data. Returns True if it will be published '''
+        stream = self._streams[device]
+        if not self._changed(stream, data):
+            if not stream.heartbeat or stream.skipped + 1 < stream.heartbeat:
+                stream.skipped += 1
+                self.counters['suppressed'] += 1
+                self.counters['suppressed_bytes'] += stream.last_size
+                return False
+        flow = self.flow
+        if flow is not None and self.spool is None and not self.batch and flow.full:
+            flow.block()                # Held back. last is unchanged so the data is offered again next interval
+            return False
+        stream.last = dict(data)        # Copy. Devices may reuse their outgoing dict
+        stream.skipped = 0
+        if self.batch:
+            self._pending.setdefault(stream.topic, {})[device] = stream.last
+        else:
+            stream.last_size = self._publish(stream.topic, stream.topic_b, stream.schema, stream.last, device)
+        return True
+
+    def flush(self):
+        ''' Batch mode. Publish one message per topic combining every device that submitted since the last flush '''
+        flow = self.flow
+        if flow is not None and self.spool is None and flow.full:
+            flow.block()                # Keep pending (latest per device) for the next flush
+            return
+        pending, self._pending = self._pending, {}
+        for topic, group in pending.items():
+            if len(group) == 1:
+                payload = next(iter(group.values()))
+            else:
+                payload = {}
+                for data in group.values():
+                    payload.update(data)
+            size = self._publish(topic, self._batchtopic[topic][1], self._batchschema[topic], payload, topic)
+            for device in group:
+                self._streams[device].last_size = size // len(group)
+
+    def _publish(self, topic, topic_b, schema, data, label):
+        metrics = self.metrics
+        t0 = perf_counter_ns()
+        payload = self.codec.encode(schema, data)
+        if metrics is not None:
+            t1 = perf_counter_ns()
+            metrics.record('encode', label, t1 - t0)
+        flow = self.flow
+        if self.spool is not None and (not self.client.connected or (flow is not None and flow.full)):
+            if flow is not None and self.client.connected:
+                flow.block()
+            self.spool.append(topic_b, payload)
+            self.counters['spooled'] += 1
+            return len(payload)
+        info = self.client.publish(topic, payload, qos=self.qos)
+        rc = info.rc
+        if flow is not None and rc == 0:
+            flow.sent(info.mid)
+        if metrics is not None:
+            metrics.record('publish', label, perf_counter_ns() - t1)
+        if rc != 0 and self.spool is not None:  # Dropped connection before on_disconnect ran
+            self.spool.append(topic_b, payload)
+            self.counters['spooled'] += 1
+            return len(payload)
+        self.counters['sent'] += 1
+        self.counters['sent_bytes'] += len(payload)
+        return len(payload)
+
+    def stats(self):
+        return dict(self.counters)
@@ -0,0 +1,171 @@
+''' Declarative device registry. Devices are listed in a JSON/TOML/YAML file instead of being built in main().
+    Driver modules are imported only when a listed device uses them, so the RPi/I2C libraries (and numpy for Mmodule)
+    are not loaded for drivers that are not in the file. Third party drivers register under the ENTRY_POINT_GROUP entry point
+
+    {"devices": [{"name": "ina219A", "driver": "piina219", "lvl2": "ina219A", "publvl3": "Test1",
+                  "data_keys": ["Vbusf", "IbusAf", "PowerWf"], "interval": 1, "bus": "i2c1",
+                  "kwargs": {"gainmode": "auto", "maxA": 0.4, "address": 64}}]}
+
+    Device fields
+    name, driver, lvl2, data_keys  -- required
+    publvl3    -- appended to MQTT_CLIENT_ID for the publish lvl3 (default '')
+    interval   -- sec between reads. null = interrupt driven (read on GPIO edges of pins)
+    pins       -- GPIO pins. Passed first to the driver and used for edge detection when interval is null
+    bus        -- polled devices sharing a bus are serialized (BusReader). Default 'i2c1'
+    kwargs     -- extra driver keyword arguments
+    logger_arg -- driver keyword for the logger. null = passed positionally after the data_keys (RotaryEncoder).
+                  Default from LOGGER_ARGS for the driver, else 'mlogger'
+    read       -- driver method returning the data dict (default 'read')
+    sampling   -- {"rate": 1000, "window": 1}. mmodule only. High-rate mode: the driver samples in the background and
+                  publishes window aggregates. data_keys are then the two sampled keys, the published keys are built from them
+    deadband, heartbeat -- see Publisher.add_device
+    logger     -- {"name": .., "level": "DEBUG", "mode": 1} passed to setup_logging. Default is the main logger '''
+import json, sys
+from importlib import import_module
+from .logutil import get_logger
+
+ENTRY_POINT_GROUP = 'nodered_mqtt.drivers'
+DRIVERS = {                                     # name -> 'module:attribute'. Imported on first use
+    'rotaryencoder': 'rotaryencoder:RotaryEncoder',
+    'piina219': 'piina219:PiINA219',
+    'mmodule': 'package.Mmodule:device',
+    'sim.rotaryencoder': 'package.sim:SimRotaryEncoder',
+    'sim.piina219': 'package.sim:SimPiINA219',
+    'sim.mmodule': 'package.sim:sim_mmodule',
+}
+SIMULATED = {'rotaryencoder': 'sim.rotaryencoder', 'piina219': 'sim.piina219', 'mmodule': 'sim.mmodule'}  # Used with simulate=True
+LOGGER_ARGS = {'rotaryencoder': None}          # driver -> logger keyword (None = positional) when the spec has no logger_arg
+REQUIRED = ('name', 'driver', 'lvl2', 'data_keys')
+DEFAULTS = {'publvl3': '', 'interval': 1, 'pins': (), 'bus': 'i2c1', 'kwargs': {}, 'read': 'read',
+            'deadband': None, 'heartbeat': 10, 'logger': None, 'sampling': None}
+
+def load_config(filename):
+    ''' Parse a .json, .toml or .yaml/.yml device file. TOML needs python 3.11+ (or pip install tomli), YAML pip install pyyaml '''
+    if filename.endswith('.json'):
+        with open(filename) as f:
+            return json.load(f)
+    if filename.endswith('.toml'):
+        try:
+            import tomllib
+        except ImportError:
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise ImportError("toml device files need python 3.11+ or 'pip install tomli'") from None
+        with open(filename, 'rb') as f:
+            return tomllib.load(f)
+    if filename.endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError("yaml device files need 'pip install pyyaml'") from None
+        with open(filename) as f:
+            return yaml.safe_load(f)
+    raise ValueError(f"Unknown device file type {filename}. Options: .json, .toml, .yaml")
+
+def load_driver(name):
+    ''' Driver class by name. Built in DRIVERS first, then installed ENTRY_POINT_GROUP entry points '''
+    target = DRIVERS.get(name)
+    if target is not None:
+        module, _, attribute = target.partition(':')
+        return getattr(import_module(module), attribute)
+    from importlib.metadata import entry_points    # Scans installed packages. Only paid for drivers that are not built in
+    try:
+        found = entry_points(group=ENTRY_POINT_GROUP)
+    except TypeError:                               # python < 3.10
+        found = entry_points().get(ENTRY_POINT_GROUP, ())
+    for entry_point in found:
+        if entry_point.name == name:
+            return entry_point.load()
+    raise ValueError(f"Unknown driver {name}. Built in: {', '.join(DRIVERS)}. Others register under '{ENTRY_POINT_GROUP}'")
+
+class DeviceRegistry:
+    ''' Validated device specs from a config file. create() builds a driver instance, importing its module on first use '''
+
+    def __init__(self, devices, simulate=False, mlogger=None):
+        self.simulate = simulate
+        self._drivers = {}      # driver name -> class (loaded on first create)
+        self.devices = []
+        names = set()
+        for i, device in enumerate(devices):
+            missing = [field for field in REQUIRED if field not in device]
+            if missing:
+                raise ValueError(f"Device {device.get('name', i)} is missing {', '.join(missing)}")
+            if device['name'] in names:
+                raise ValueError(f"Device {device['name']} already in use. Device name should be unique")
+            names.add(device['name'])
+            spec = dict(DEFAULTS, **device)
+            spec.setdefault('logger_arg', LOGGER_ARGS.get(spec['driver'], 'mlogger'))
+            spec['data_keys'] = [sys.intern(key) for key in spec['data_keys']]  # Driver outgoing dicts share the key objects
+            spec['driver_keys'] = spec.get('driver_keys', spec['data_keys'])   # Passed to the driver. Already set in shard worker specs
+            if spec['sampling'] is not None:
+                if spec['driver'] != 'mmodule' or len(spec['driver_keys']) != 2:
+                    raise ValueError(f"Device {spec['name']}: sampling needs the mmodule driver and two data_keys")
+                from .Mmodule import aggregate_keys     # Only imported when a spec samples
+                keys = aggregate_keys(*spec['driver_keys'], energy_key=spec['kwargs'].get('energy_key', 'EJf'))
+                spec['data_keys'] = [sys.intern(key) for key in keys]   # Published keys
+                spec['read'] = 'aggregate'
+            self.devices.append(spec)
+        self.logger = get_logger(mlogger, __name__)
+
+    @classmethod
+    def from_file(cls, filename, simulate=False, mlogger=None):
+        return cls(load_config(filename).get('devices', []), simulate=simulate, mlogger=mlogger)
+
+    def driver(self, name):
+        if self.simulate:
+            name = SIMULATED.get(name, name)
+        driver = self._drivers.get(name)
+        if driver is None:
+            driver = self._drivers[name] = load_driver(name)
+            self.logger.info(f"Loaded driver {name}")
+        return driver
+
+    def create(self, spec, mlogger=None):
+        ''' Driver instance. Called like the original setup code: driver(*pins, *data_keys, **{logger_arg: mlogger}, **kwargs),
+            or driver(*pins, *data_keys, mlogger, **kwargs) when logger_arg is None. Starts sampling for sampling specs '''
+        driver = self.driver(spec['driver'])
+        if spec['logger_arg'] is None:
+            instance = driver(*spec['pins'], *spec['driver_keys'], mlogger, **spec['kwargs'])
+        else:
+            instance = driver(*spec['pins'], *spec['driver_keys'], **{spec['logger_arg']: mlogger}, **spec['kwargs'])
+        if spec['sampling'] is not None:
+            instance.start_sampling(**spec['sampling'])
+        return instance
+
+class DeviceRecord:
+    ''' One deviceD entry. Topics and keys are built (and interned) once in setup_device, not per message '''
+    __slots__ = ('name', 'lvl2', 'interval', 'msginterval', 'keys', 'data', 'cmd', 'subtopic', 'pubtopic', 'schematopic', 'late', 'send')
+
+    def __init__(self, name, lvl2, interval, keys, subtopic, pubtopic, schematopic):
+        self.name = name
+        self.lvl2 = sys.intern(lvl2)    # Sub/Pub lvl2 in topics. Does not have to be unique, can piggy-back on another device lvl2
+        self.interval = interval        # Sampling/publish interval (sec). None if device is only interrupt driven
+        self.msginterval = interval     # Interval actually scheduled. interval stretched by flow control while the broker is behind
+        self.keys = tuple(sys.intern(key) for key in keys)
+        self.data = dict.fromkeys(self.keys, 0)     # Latest data
+        self.cmd = {}                   # Latest command payload per sub lvl3 (default cmd_handler)
+        self.subtopic = sys.intern(subtopic)
+        self.pubtopic = sys.intern(pubtopic)
+        self.schematopic = sys.intern(schematopic)  # Retained codec + key order for pubtopic
+        self.late = False               # Missed the last bus read deadline
+        self.send = False
+
+class DeviceTable(dict):
+    ''' deviceD. device name -> DeviceRecord plus a (lvl2, data key) -> device index so duplicate keys are found in O(1) '''
+
+    def __init__(self):
+        super().__init__()
+        self.owners = {}        # (lvl2, key) -> first device publishing key on lvl2
+
+    def add(self, record):
+        ''' Returns [(key, device)] for keys another device already publishes on the same lvl2 '''
+        if record.name in self:
+            raise ValueError(f"Device {record.name} already in use. Device name should be unique")
+        self[record.name] = record
+        duplicates = []
+        for key in record.keys:
+            owner = self.owners.setdefault((record.lvl2, key), record.name)
+            if owner != record.name:
+                duplicates.append((key, owner))
+        return duplicates
@@ -0,0 +1,163 @@
+import heapq, itertools, threading
+from collections import deque
+from functools import partial
+from time import perf_counter
+from .logutil import get_logger
+
+def _read_then(read, callback):
+    callback(read())
+
+class TaskStats:
+    ''' Timing stats for one scheduled device. Jitter is how late a task ran vs its deadline '''
+
+    __slots__ = ('runs', 'edges', 'missed', 'jitter_sum', 'jitter_max')
+
+    def __init__(self):
+        self.runs = 0          # Timer driven runs
+        self.edges = 0         # Interrupt (call_soon) driven runs
+        self.missed = 0        # Deadlines skipped because the task ran more than one interval late
+        self.jitter_sum = 0.0  # sec
+        self.jitter_max = 0.0  # sec
+
+    def update(self, lateness):
+        self.jitter_sum += lateness
+        if lateness > self.jitter_max:
+            self.jitter_max = lateness
+
+    def as_dict(self):
+        count = self.runs + self.edges
+        return {'runs': self.runs, 'edges': self.edges, 'missed': self.missed,
+                'jitter_avg_ms': round(self.jitter_sum / count * 1000, 3) if count else 0.0,
+                'jitter_max_ms': round(self.jitter_max * 1000, 3)}
+
+class _Task:
+    __slots__ = ('name', 'interval', 'callback', 'generation', 'stats')
+
+    def __init__(self, name, interval, callback):
+        self.name = name
+        self.interval = interval
+        self.callback = callback
+        self.generation = 0    # Bumped on interval change/remove so stale heap entries are skipped
+        self.stats = TaskStats()
+
+class Scheduler:
+    ''' Timer heap scheduler. Each device gets its own interval and the thread sleeps until the next deadline.
+        Edge triggered sources (GPIO interrupt callbacks) hand work to the loop with call_soon '''
+
+    def __init__(self, mlogger=None):
+        self._heap = []                    # (deadline, seq, generation, task)
+        self._seq = itertools.count()      # Tie breaker so tasks with equal deadlines never get compared
+        self._tasks = {}
+        self._pending = deque()            # (name, callback, t_event) queued from other threads. deque append/popleft is thread safe
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._running = False
+        self.logger = get_logger(mlogger, __name__)
+
+    def add_task(self, name, interval, callback, start_delay=None, read=None):
+        ''' Run callback every interval (sec). First run is after start_delay (defaults to one interval)
+            If read is given the task runs callback(read()) (same signature as AsyncRuntime, which runs read in an executor) '''
+        if interval <= 0:
+            raise ValueError(f"Interval for {name} must be > 0")
+        if read is not None:
+            callback = partial(_read_then, read, callback)
+        with self._lock:
+            task = self._tasks.get(name)
+            if task is None:
+                task = self._tasks[name] = _Task(name, interval, callback)
+            else:
+                task.interval, task.callback = interval, callback
+                task.generation += 1
+            first = perf_counter() + (interval if start_delay is None else start_delay)
+            heapq.heappush(self._heap, (first, next(self._seq), task.generation, task))
+        self._wake.set()
+
+    def set_interval(self, name, interval):
+        ''' Change a task interval at runtime. Next run is rescheduled from now '''
+        task = self._tasks[name]
+        self.add_task(name, interval, task.callback)
+
+    def get_interval(self, name):
+        return self._tasks[name].interval
+
+    def remove_task(self, name):
+        with self._lock:
+            task = self._tasks.pop(name, None)
+            if task is not None:
+                task.generation += 1
+
+    def call_soon(self, name, callback, read=None):
+        ''' Thread safe. Used from GPIO interrupt callbacks to run a device read on the scheduler thread '''
+        if read is not None:
+            callback = partial(_read_then, read, callback)
+        self._pending.append((name, callback, perf_counter()))
+        self._wake.set()
+
+    def stats(self):
+        ''' Timing stats per device {name: {runs, edges, missed, jitter_avg_ms, jitter_max_ms}} '''
+        return {name: task.stats.as_dict() for name, task in self._tasks.items()}
+
+    def _edge_stats(self, name):
+        task = self._tasks.get(name)
+        if task is None:                # Edge only device (no timer). Track stats without scheduling it
+            with self._lock:
+                task = self._tasks.setdefault(name, _Task(name, None, None))
+        return task.stats
+
+    def run_pending(self):
+        ''' Run callbacks queued by call_soon. Returns number ran '''
+        ran = 0
+        while self._pending:
+            name, callback, t_event = self._pending.popleft()
+            stats = self._edge_stats(name)
+            stats.edges += 1
+            stats.update(perf_counter() - t_event)
+            try:
+                callback()
+            except Exception:           # One failing device must not stop the loop (same as AsyncRuntime._run_task)
+                self.logger.exception(f"Task {name} failed")
+            ran += 1
+        return ran
+
+    def run_due(self):
+        ''' Run every timer task whose deadline has passed. Returns sec until the next deadline (None if no tasks) '''
+        heap = self._heap
+        while True:
+            with self._lock:            # add_task/set_interval may push from other threads (ie mqtt callbacks)
+                if not heap:
+                    return None
+                deadline, _, generation, task = heap[0]
+                if generation != task.generation or self._tasks.get(task.name) is not task:
+                    heapq.heappop(heap) # Stale entry from set_interval/remove_task
+                    continue
+                now = perf_counter()
+                if deadline > now:
+                    return deadline - now
+                heapq.heappop(heap)
+                lateness = now - deadline
+                if lateness >= task.interval:   # Fell behind. Skip the missed periods instead of running a burst to catch up
+                    missed = int(lateness // task.interval)
+                    task.stats.missed += missed
+                    deadline += missed * task.interval
+                heapq.heappush(heap, (deadline + task.interval, next(self._seq), generation, task))
+            task.stats.runs += 1
+            task.stats.update(lateness)
+            try:
+                task.callback()
+            except Exception:
+                self.logger.exception(f"Task {task.name} failed")
+
+    def run(self):
+        ''' Blocking loop. Sleeps until the next deadline or until woken by call_soon/stop '''
+        self._running = True
+        while self._running:
+            self._wake.clear()
+            self.run_pending()
+            timeout = self.run_due()
+            if self._pending:
+                continue
+            self._wake.wait(timeout)
+
+    def stop(self):
+        self._running = False
+        self._wake.set()
@@ -0,0 +1,235 @@
+''' Multi-process sharding. Polled devices are split into groups that run in worker processes (one core each) and
+    write readings into a shared memory table. The main process keeps the mqtt connection, reads the table and publishes,
+    so a crashed worker is restarted without dropping the connection and readings never go through pickling/pipes.
+
+    SharedTable slot per device, fixed offsets, little endian, 8 byte aligned
+    version  Q   -- seqlock. Odd while the worker is writing. Readers retry until the same even version is seen before and after
+    stamp    d   -- time.time() of the reading
+    interval d   -- read interval (sec). Written by the main process (flow control, Node-RED), picked up by the worker
+    values   d*n -- one float64 per data_key in key order (NaN = missing/non numeric) '''
+import logging, math, signal, struct
+import multiprocessing as mp
+from logging.handlers import QueueHandler, QueueListener
+from multiprocessing import shared_memory
+from time import perf_counter, time
+from .logutil import get_logger
+
+_VERSION = struct.Struct('<Q')
+_FLOAT = struct.Struct('<d')
+_HEADER = 24                    # version + stamp + interval
+
+class SharedTable:
+    ''' Fixed layout table of device readings in multiprocessing.shared_memory. One writer (worker) per device '''
+
+    def __init__(self, layout, name=None):
+        ''' layout {device: (data keys)}. name=None creates the block, otherwise attaches to it '''
+        self.layout = {device: tuple(keys) for device, keys in layout.items()}
+        self.offsets = {}
+        self._values = {}       # device -> Struct for its values
+        size = 0
+        for device, keys in self.layout.items():
+            self.offsets[device] = size
+            self._values[device] = struct.Struct('<' + 'd' * len(keys))
+            size += _HEADER + 8 * len(keys)
+        if name is None:
+            self._shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+            self._shm.buf[:size] = bytes(size)
+            self.owner = True
+        else:
+            try:
+                self._shm = shared_memory.SharedMemory(name=name, track=False)  # python 3.13+
+            except TypeError:           # Workers share the supervisor's resource tracker, which unlinks once at the end
+                self._shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.name = self._shm.name
+        self._buf = self._shm.buf
+        self._version = {}      # Writer side version per device
+
+    def write(self, device, data):
+        ''' Worker side. data {key: value}. Non numeric or missing values are stored as NaN '''
+        buf, offset = self._buf, self.offsets[device]
+        version = self._version.get(device)
+        if version is None:     # First write since (re)start. Continue from the table, past any write a crash left open
+            version = _VERSION.unpack_from(buf, offset)[0]
+            version += version & 1
+        values = []
+        for key in self.layout[device]:
+            value = data.get(key)
+            values.append(float(value) if isinstance(value, (int, float)) else math.nan)
+        _VERSION.pack_into(buf, offset, version + 1)           # Odd. Readers retry
+        _FLOAT.pack_into(buf, offset + 8, time())
+        self._values[device].pack_into(buf, offset + _HEADER, *values)
+        _VERSION.pack_into(buf, offset, version + 2)
+        self._version[device] = version + 2
+
+    def read(self, device, retries=100):
+        ''' (version, stamp, values) of a consistent reading. version 0 = never written. None if the writer stayed busy '''
+        buf, offset, unpack = self._buf, self.offsets[device], self._values[device].unpack_from
+        for i in range(retries):
+            version = _VERSION.unpack_from(buf, offset)[0]
+            if version & 1:
+                continue
+            stamp = _FLOAT.unpack_from(buf, offset + 8)[0]
+            values = unpack(buf, offset + _HEADER)
+            if _VERSION.unpack_from(buf, offset)[0] == version:
+                return version, stamp, values
+        return None
+
+    def set_interval(self, device, interval):
+        _FLOAT.pack_into(self._buf, self.offsets[device] + 16, interval)
+
+    def get_interval(self, device):
+        return _FLOAT.unpack_from(self._buf, self.offsets[device] + 16)[0]
+
+    def close(self):
+        self._buf = None
+        self._shm.close()
+        if self.owner:
+            self._shm.unlink()
+
+class _Forward(logging.Handler):
+    ''' Hands worker log records (from the QueueListener) to the supervisor's logger and its handlers.
+        Renamed to the supervisor's logger so name routed handlers (queue mode setup_logging) pick them up '''
+
+    def __init__(self, target):
+        super().__init__()
+        self.target = target
+
+    def emit(self, record):
+        record.msg = f"[{record.name}] {record.msg}"
+        record.name = self.target.name
+        self.target.handle(record)
+
+def _shard_main(shard, name, layout, specs, simulate, stop, log_queue, log_level):
+    ''' Worker process. Reads its devices with a BusReader + Scheduler and writes results into the table '''
+    from functools import partial
+    from .busreader import BusReader
+    from .registry import DeviceRegistry
+    from .scheduler import Scheduler
+    signal.signal(signal.SIGINT, signal.SIG_IGN)   # ctrl-C goes to the whole process group. The supervisor stops workers
+    logger = logging.getLogger(f"shard{shard}")
+    logger.addHandler(QueueHandler(log_queue))
+    logger.setLevel(log_level)
+    logger.propagate = False
+    table = SharedTable(layout, name=name)
+    registry = DeviceRegistry(specs, simulate=simulate, mlogger=logger)
+    busreader = BusReader(max_workers=4, mlogger=logger)
+    for spec in registry.devices:
+        driver = registry.create(spec, logger)
+        busreader.add_device(spec['name'], spec['bus'], getattr(driver, spec['read']))
+    scheduler = Scheduler(mlogger=logger)
+    tasks = []
+
+    def store(reads):
+        results = reads[0]
+        for device, data in results.items():
+            if data is not None:
+                table.write(device, data)
+
+    def schedule():
+        ''' One task per distinct interval (same as schedule_bus_reads). Intervals come from the table '''
+        for task in tasks:
+            scheduler.remove_task(task)
+        tasks.clear()
+        groups = {}
+        for device in busreader.devices():
+            groups.setdefault(table.get_interval(device), []).append(device)
+        for interval, devices in groups.items():
+            tasks.append(f"busread@{interval}s")
+            scheduler.add_task(tasks[-1], interval, store, read=partial(busreader.read, devices, interval * 0.8))
+        return {device: table.get_interval(device) for device in busreader.devices()}
+
+    intervals = schedule()
+    def check():
+        nonlocal intervals
+        if stop.is_set():
+            scheduler.stop()
+        elif any(table.get_interval(device) != interval for device, interval in intervals.items()):
+            intervals = schedule()
+    scheduler.add_task('control', 0.2, check)
+    logger.info(f"reading {', '.join(busreader.devices())}")
+    try:
+        scheduler.run()
+    finally:
+        busreader.shutdown()
+        table.close()
+
+class ShardSupervisor:
+    ''' Splits polled device specs (DeviceRegistry.devices) over worker processes and restarts workers that exit.
+        Devices sharing a bus stay in the same worker so the BusReader bus lock still serializes them.
+        Call check() periodically (scheduler task). Restarts back off from restart_delay up to 30 sec '''
+
+    def __init__(self, specs, shards=2, simulate=False, mlogger=None, restart_delay=1.0):
+        self.logger = get_logger(mlogger, __name__)
+        self.simulate = simulate
+        self.restart_delay = restart_delay
+        self.table = SharedTable({spec['name']: spec['data_keys'] for spec in specs})
+        for spec in specs:
+            self.table.set_interval(spec['name'], spec['interval'])
+        buses = {}
+        for spec in specs:
+            buses.setdefault(spec['bus'], []).append(spec)
+        self.groups = [[] for i in range(min(shards, len(buses)) or 1)]
+        for bus_specs in sorted(buses.values(), key=len, reverse=True):    # Largest bus first onto the emptiest shard
+            min(self.groups, key=len).extend(bus_specs)
+        self._ctx = mp.get_context('spawn')     # Fresh interpreter. No inherited threads (paho, logging) or locks
+        self._stop = self._ctx.Event()
+        self._log_queue = self._ctx.Queue()
+        self._listener = QueueListener(self._log_queue, _Forward(self.logger))  # Worker records go to the supervisor's logger
+        self._procs = [None] * len(self.groups)
+        self._failures = [0] * len(self.groups)     # Consecutive restarts
+        self._next_start = [0.0] * len(self.groups)
+        self._started = [0.0] * len(self.groups)
+        self.restarts = 0
+
+    def _start(self, shard):
+        proc = self._ctx.Process(target=_shard_main, name=f"shard{shard}", daemon=True,
+                                 args=(shard, self.table.name, self.table.layout, self.groups[shard], self.simulate,
+                                       self._stop, self._log_queue, self.logger.getEffectiveLevel()))
+        proc.start()
+        self._procs[shard] = proc
+        self._started[shard] = perf_counter()
+
+    def start(self):
+        self._listener.start()
+        for shard in range(len(self.groups)):
+            self._start(shard)
+        self.logger.info(f"{len(self.groups)} shards: " + '; '.join(', '.join(spec['name'] for spec in group) for group in self.groups))
+
+    def check(self):
+        ''' Restart workers that exited. Returns number restarted '''
+        restarted = 0
+        now = perf_counter()
+        for shard, proc in enumerate(self._procs):
+            if proc is None or proc.is_alive() or self._stop.is_set():
+                continue
+            if not self._next_start[shard]:
+                if now - self._started[shard] > 60:     # Ran fine for a while. Start over with the short delay
+                    self._failures[shard] = 0
+                delay = min(self.restart_delay * 2 ** self._failures[shard], 30)
+                self._next_start[shard] = now + delay
+                self.logger.warning(f"shard{shard} exited with {proc.exitcode}. Restarting in {delay} sec")
+            if now >= self._next_start[shard]:
+                self._failures[shard] += 1
+                self._next_start[shard] = 0.0
+                self._start(shard)
+                self.restarts += 1
+                restarted += 1
+        return restarted
+
+    def devices(self):
+        return list(self.table.layout)
+
+    def stats(self):
+        return {'shards': len(self.groups), 'alive': sum(1 for proc in self._procs if proc is not None and proc.is_alive()),
+                'restarts': self.restarts}
+
+    def stop(self, timeout=2):
+        self._stop.set()
+        for proc in self._procs:
+            if proc is not None:
+                proc.join(timeout)
+                if proc.is_alive():
+                    proc.terminate()
+        self._listener.stop()
+        self.table.close()
@@ -0,0 +1,374 @@
+''' Simulated hardware and broker so the data path can run and be benchmarked off the Pi.
+    GPIO                   -- stand-in for RPi.GPIO (edge callbacks fired by simulated devices)
+    SimINA219/SimPiINA219  -- voltage/current sensor with a configurable conversion rate and bus transaction time
+    sim_mmodule            -- Mmodule.device on a SimINA219 (registry driver 'mmodule' with simulate=True)
+    SimRotaryEncoder       -- generates clicks at a configurable rate and fires GPIO edges like the real encoder
+    SimBroker/SimClient    -- in-process mqtt broker and a paho.mqtt.client.Client look-alike (loop_start style) '''
+import itertools, logging, math, queue, threading
+from collections import deque
+from time import perf_counter, sleep
+from types import SimpleNamespace
+from .topicrouter import TopicRouter
+
+#==== GPIO ====#
+class SimGPIO:
+    ''' Subset of RPi.GPIO used by the scripts. set_level(pin) calls the registered event callback like the RPi.GPIO thread '''
+    BCM, BOARD = 11, 10
+    IN, OUT = 1, 0
+    LOW, HIGH = 0, 1
+    PUD_OFF, PUD_DOWN, PUD_UP = 20, 21, 22
+    RISING, FALLING, BOTH = 31, 32, 33
+
+    def __init__(self):
+        self._levels = {}
+        self._callbacks = {}
+
+    def setmode(self, mode): pass
+    def setwarnings(self, flag): pass
+
+    def setup(self, pin, direction, pull_up_down=None, initial=0):
+        self._levels[pin] = 1 if pull_up_down == self.PUD_UP else initial
+
+    def input(self, pin):
+        return self._levels.get(pin, 0)
+
+    def output(self, pin, level):
+        self._levels[pin] = level
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        self._callbacks[pin] = callback
+
+    def remove_event_detect(self, pin):
+        self._callbacks.pop(pin, None)
+
+    def set_level(self, pin, level):
+        ''' Simulate an input change. Fires the event callback '''
+        self._levels[pin] = level
+        callback = self._callbacks.get(pin)
+        if callback is not None:
+            callback(pin)
+
+    def cleanup(self, *pins):
+        self._callbacks.clear()
+        self._levels.clear()
+
+GPIO = SimGPIO()
+
+#==== Devices ====#
+class SimINA219:
+    ''' Same read methods as the ina219 library INA219 plus the raw register interface of Mmodule.INA219Burst
+        (registers/bus_register). New conversions are produced at rate (Hz) and each register transaction costs
+        bus_time sec (ie ~0.0003 at 400kHz I2C). Voltage ~5V and current ~load_ma with ripple + noise '''
+    current_lsb_ua = 20         # Calibration the raw registers are scaled with
+    power_lsb_uw = 400          # 20 * current_lsb
+
+    def __init__(self, rate=1000, bus_time=0.0, load_ma=250.0, noise=0.01):
+        self.rate = rate
+        self.bus_time = bus_time
+        self.load_ma = load_ma
+        self.noise = noise
+        self._t0 = perf_counter()
+        self._consumed = -1     # Conversion number last read through the power register (clears conversion ready)
+        self.reads = 0          # Register transactions
+
+    def _sample(self):
+        n = int((perf_counter() - self._t0) * self.rate)   # Conversion number. Value only changes when a new conversion is ready
+        ripple = math.sin(n / 50)
+        noise = ((n * 2654435761) % 2001 / 1000 - 1) * self.noise  # Deterministic per conversion, +-noise
+        return n, ripple, noise
+
+    def _transaction(self):
+        self.reads += 1
+        if self.bus_time:
+            sleep(self.bus_time)
+
+    def voltage(self):
+        self._transaction()
+        n, ripple, noise = self._sample()
+        return 5.0 + 0.05 * ripple + noise
+
+    def current(self):
+        self._transaction()
+        n, ripple, noise = self._sample()
+        return self.load_ma * (1 + 0.1 * ripple) + noise * 100
+
+    def power(self):
+        return self.voltage() * self.current()
+
+    def _bus_raw(self, n, ripple, noise):
+        mv = int((5.0 + 0.05 * ripple + noise) * 1000)
+        return (mv // 4) << 3 | (2 if n > self._consumed else 0)   # Bits 15-3 voltage (4mV), bit 1 conversion ready
+
+    def bus_register(self):
+        ''' One transaction. Raw bus voltage register (poll bit 1 for conversion ready) '''
+        self._transaction()
+        return self._bus_raw(*self._sample())
+
+    def registers(self):
+        ''' One burst transaction. Raw (bus, shunt, current, power) registers. Reading power clears conversion ready '''
+        self._transaction()
+        n, ripple, noise = self._sample()
+        bus = self._bus_raw(n, ripple, noise)
+        ma = self.load_ma * (1 + 0.1 * ripple) + noise * 100
+        current = int(ma * 1000 / self.current_lsb_ua)
+        shunt = int(ma * 10)    # 10uV LSB across 0.1 ohm
+        power = int((bus >> 3) * 4 * ma / self.power_lsb_uw)
+        self._consumed = n
+        return bus, shunt, current, power
+
+    def shunt_voltage(self):
+        return self.current() * 0.1     # mV across 0.1 ohm shunt
+
+    def supply_voltage(self):
+        return self.voltage() + self.shunt_voltage() / 1000
+
+class SimPiINA219:
+    ''' Stand-in for piina219.PiINA219. read() returns {key1: V, key2: A, key3: W} '''
+
+    def __init__(self, key1='Vbusf', key2='IbusAf', key3='PowerWf', gainmode="auto", maxA=0.4, address=0x40,
+                 mlogger=None, rate=1000, bus_time=0.0):
+        self.keys = (key1, key2, key3)
+        self.address = address
+        self.ina219 = SimINA219(rate=rate, bus_time=bus_time)
+        self.outgoing = {}
+        self.logger = mlogger if mlogger is not None else logging.getLogger(__name__)
+
+    def read(self):
+        volts = self.ina219.voltage()
+        amps = self.ina219.current() / 1000
+        self.outgoing[self.keys[0]] = round(volts, 2)
+        self.outgoing[self.keys[1]] = round(amps, 3)
+        self.outgoing[self.keys[2]] = round(volts * amps, 3)
+        return self.outgoing
+
+def sim_mmodule(*keys, bus=1, shunt_ohms=0.1, max_expected_amps=0.4, rate=1000, bus_time=0.0, **kwargs):
+    ''' Mmodule.device reading a SimINA219 instead of building an INA219Burst. I2C arguments are accepted and ignored '''
+    from .Mmodule import device     # Mmodule (numpy) is only imported for specs that use it
+    return device(*keys, ina219=SimINA219(rate=rate, bus_time=bus_time), **kwargs)
+
+class SimRotaryEncoder:
+    ''' Stand-in for rotaryencoder.RotaryEncoder. A background thread turns the knob at rate clicks/sec and
+        toggles clkPin through GPIO so edge callbacks fire. runencoder() returns data once per change, else None '''
+
+    def __init__(self, clkPin, dtPin, button, key1='RotEnc1Ci', key2='RotEnc1Bi', mlogger=None, rate=10, gpio=GPIO):
+        self.clkPin, self.dtPin, self.button = clkPin, dtPin, button
+        self.key1, self.key2 = key1, key2
+        self.rate = rate
+        self.gpio = gpio
+        self.counter = 0
+        self._reported = 0
+        self._lock = threading.Lock()
+        self._running = False
+        for pin in (clkPin, dtPin, button):
+            gpio.setup(pin, gpio.IN, pull_up_down=gpio.PUD_UP)
+
+    def start(self):
+        ''' Start turning the knob '''
+        self._running = True
+        threading.Thread(target=self._turn, daemon=True).start()
+
+    def stop(self):
+        self._running = False
+
+    def _turn(self):
+        period = 1 / self.rate
+        while self._running:
+            sleep(period)
+            with self._lock:
+                self.counter += 1
+            self.gpio.set_level(self.clkPin, 1 - self.gpio.input(self.clkPin))
+
+    def runencoder(self):
+        with self._lock:
+            if self.counter == self._reported:
+                return None
+            self._reported = self.counter
+            return {self.key1: self.counter, self.key2: 0}
+
+#==== MQTT ====#
+class SimMessage:
+    __slots__ = ('topic', 'payload', 'qos', 'retain', 'mid')
+
+    def __init__(self, topic, payload, qos=0, retain=False, mid=0):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.mid = mid
+
+class SimMessageInfo:
+    ''' Like paho MQTTMessageInfo '''
+    __slots__ = ('rc', 'mid')
+
+    def __init__(self, rc, mid):
+        self.rc = rc
+        self.mid = mid
+
+    def is_published(self):
+        return self.rc == 0
+
+    def wait_for_publish(self, timeout=None):
+        pass
+
+class SimBroker:
+    ''' In-process broker. Routes publishes to subscribed SimClients with the same + / # matching as mqtt. Keeps retained messages '''
+
+    def __init__(self):
+        self._router = TopicRouter()
+        self._subs = []         # (pattern, client)
+        self._retained = {}
+        self._lock = threading.Lock()
+        self.published = 0
+
+    def subscribe(self, client, pattern, qos=0):
+        with self._lock:
+            self._subs.append((pattern, client))
+            self._router.add(pattern, client._deliver)
+            check = TopicRouter()
+            check.add(pattern, client._deliver)
+            retained = [msg for topic, msg in self._retained.items() if check.match(topic)]
+        for msg in retained:
+            client._deliver(msg.topic.split('/'), msg)
+
+    def unsubscribe_all(self, client):
+        with self._lock:
+            for pattern, sub in self._subs:
+                if sub is client:
+                    self._router.remove(pattern, client._deliver)
+            self._subs = [(pattern, sub) for pattern, sub in self._subs if sub is not client]
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        msg = SimMessage(topic, payload, qos, retain)
+        with self._lock:
+            self.published += 1
+            if retain:
+                self._retained[topic] = msg
+            handlers = list(self._router.match(topic))
+        levels = topic.split('/')
+        for handler in handlers:
+            handler(levels, msg)
+
+BROKER = SimBroker()    # Default broker shared by SimClients created without one
+
+class SimClient:
+    ''' paho.mqtt.client.Client look-alike for SimBroker. Callbacks run on a per client network thread (loop_start)
+        with the same signatures as paho 1.x. Not usable with AsyncRuntime (there is no socket) '''
+
+    def __init__(self, client_id='', clean_session=None, userdata=None, broker=None, latency=0.0, ack_delay=0.0):
+        self._client_id = client_id
+        self._userdata = userdata
+        self.broker = broker if broker is not None else BROKER
+        self.latency = latency      # sec added to every delivery (network round trip)
+        self.ack_delay = ack_delay  # sec until on_publish (slow broker/PUBACK). Messages stay in flight meanwhile
+        self._acks = deque()        # (due, mid) delayed on_publish calls, in order
+        self._mid = itertools.count(1)
+        self._inbox = queue.SimpleQueue()
+        self._thread = None
+        self._connected = False
+        self.on_connect = self.on_disconnect = self.on_message = self.on_publish = self.on_subscribe = None
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def connect(self, host, port=1883, keepalive=60, **kwargs):
+        self._connected = True
+        self._inbox.put((self._call, ('on_connect', self._userdata, {}, 0)))
+        return 0
+
+    def reconnect(self):
+        return self.connect(None)
+
+    def is_connected(self):
+        return self._connected
+
+    def disconnect(self):
+        self._connected = False
+        self.broker.unsubscribe_all(self)
+        self._inbox.put((self._call, ('on_disconnect', self._userdata, 0)))
+        return 0
+
+    def subscribe(self, topic, qos=0):
+        ''' topic can be a list of (topic, qos) like paho (one SUBSCRIBE for all of them) '''
+        mid = next(self._mid)
+        topics = topic if isinstance(topic, list) else [(topic, qos)]
+        for pattern, pattern_qos in topics:
+            self.broker.subscribe(self, pattern, pattern_qos)
+        self._inbox.put((self._call, ('on_subscribe', self._userdata, mid, tuple(pattern_qos for pattern, pattern_qos in topics))))
+        return 0, mid
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        mid = next(self._mid)
+        if not self._connected:
+            return SimMessageInfo(4, mid)   # MQTT_ERR_NO_CONN
+        if isinstance(payload, str):
+            payload = payload.encode()
+        if self.latency:
+            sleep(self.latency)
+        self.broker.publish(topic, payload, qos, retain)
+        if self.ack_delay:
+            self._acks.append((perf_counter() + self.ack_delay, mid))
+        else:
+            self._inbox.put((self._call, ('on_publish', self._userdata, mid)))
+        return SimMessageInfo(0, mid)
+
+    def _deliver(self, levels, msg):
+        self._inbox.put((self._call, ('on_message', self._userdata, msg)))
+
+    def _call(self, name, *args):
+        callback = getattr(self, name)
+        if callback is not None:
+            callback(self, *args)
+
+    def loop_start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.loop_forever, daemon=True)
+            self._thread.start()
+        return 0
+
+    def loop_stop(self, force=False):
+        if self._thread is not None:
+            self._inbox.put(None)
+            if threading.current_thread() is not self._thread:
+                self._thread.join()
+            self._thread = None
+        return 0
+
+    def _due_acks(self):
+        ''' Run on_publish for delayed acks that are due. Returns sec until the next one (None if none pending) '''
+        acks = self._acks
+        while acks:
+            due, mid = acks[0]
+            wait = due - perf_counter()
+            if wait > 0:
+                return wait
+            acks.popleft()
+            self._call('on_publish', self._userdata, mid)
+        return None
+
+    def loop_forever(self, *args, **kwargs):
+        while True:
+            timeout = None
+            if self.ack_delay:          # Wake for the next due ack. Acks queued while idle are at most ack_delay away
+                timeout = self._due_acks() or self.ack_delay
+            try:
+                item = self._inbox.get(timeout=timeout)
+            except queue.Empty:
+                continue
+            if item is None:
+                return
+            fn, args = item
+            fn(*args)
+
+    def loop(self, timeout=1.0):
+        ''' Process pending callbacks in the calling thread '''
+        self._due_acks()
+        while True:
+            try:
+                item = self._inbox.get_nowait()
+            except queue.Empty:
+                return 0
+            if item is not None:
+                fn, args = item
+                fn(*args)
+
+mqtt = SimpleNamespace(Client=SimClient, MQTTMessage=SimMessage, MQTTMessageInfo=SimMessageInfo) # Drop in for paho.mqtt.client
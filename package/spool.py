@@ -0,0 +1,148 @@
+import mmap, os, struct, threading
+from time import time, perf_counter
+
+class Spool:
+    ''' Store-and-forward buffer for outbound messages. Memory-mapped, append-only ring file with a fixed size.
+        When full the oldest messages are dropped. Survives restarts (head/tail are kept in the file header) '''
+
+    MAGIC = b'SPL1'
+    HEADER = struct.Struct('<4sQQQ')   # magic, head, tail, dropped. head/tail are ever increasing byte offsets
+    HEADER_SIZE = 32
+    RECORD = struct.Struct('<IHd')     # record length, topic length, time spooled (epoch sec)
+
+    def __init__(self, filename, max_bytes=16 * 2**20):
+        self.filename = filename
+        new = not os.path.exists(filename) or os.path.getsize(filename) != max_bytes
+        self._fd = os.open(filename, os.O_RDWR | os.O_CREAT)
+        if new:
+            os.ftruncate(self._fd, max_bytes)
+        self._mm = mmap.mmap(self._fd, max_bytes)
+        self.capacity = max_bytes - self.HEADER_SIZE
+        self._lock = threading.Lock()
+        magic, self._head, self._tail, self.dropped = self.HEADER.unpack_from(self._mm, 0)
+        if new or magic != self.MAGIC:
+            self._head = self._tail = self.dropped = 0
+            self._write_header()
+        self.depth = self._count()
+        self.replayed = 0
+
+    def _write_header(self):
+        self.HEADER.pack_into(self._mm, 0, self.MAGIC, self._head, self._tail, self.dropped)
+
+    def _write(self, pos, data):
+        ''' Write at logical position, wrapping at the end of the ring '''
+        offset = pos % self.capacity
+        first = min(len(data), self.capacity - offset)
+        start = self.HEADER_SIZE + offset
+        self._mm[start:start + first] = data[:first]
+        if first < len(data):
+            self._mm[self.HEADER_SIZE:self.HEADER_SIZE + len(data) - first] = data[first:]
+
+    def _read(self, pos, size):
+        offset = pos % self.capacity
+        first = min(size, self.capacity - offset)
+        start = self.HEADER_SIZE + offset
+        data = self._mm[start:start + first]
+        if first < size:
+            data += self._mm[self.HEADER_SIZE:self.HEADER_SIZE + size - first]
+        return data
+
+    def _count(self):
+        count, pos = 0, self._head
+        while pos < self._tail:
+            pos += self.RECORD.unpack(self._read(pos, self.RECORD.size))[0]
+            count += 1
+        return count
+
+    @property
+    def bytes(self):
+        return self._tail - self._head
+
+    def append(self, topic, payload):
+        ''' Spool one message. topic and payload str or bytes '''
+        if isinstance(payload, str):
+            payload = payload.encode()
+        topic_b = topic if isinstance(topic, bytes) else topic.encode()
+        size = self.RECORD.size + len(topic_b) + len(payload)
+        if size > self.capacity:
+            raise ValueError(f"Message of {size} bytes does not fit spool of {self.capacity} bytes")
+        with self._lock:
+            while self._tail - self._head + size > self.capacity:   # Full. Drop oldest
+                self._head += self.RECORD.unpack(self._read(self._head, self.RECORD.size))[0]
+                self.depth -= 1
+                self.dropped += 1
+            self._write(self._tail, self.RECORD.pack(size, len(topic_b), time()) + topic_b + payload)
+            self._tail += size
+            self.depth += 1
+            self._write_header()    # Header last so a crash mid write leaves the previous tail
+
+    def peek(self, n):
+        ''' Oldest n messages as [(topic, payload bytes, time spooled)] without removing them '''
+        out = []
+        with self._lock:
+            pos = self._head
+            while pos < self._tail and len(out) < n:
+                size, topic_len, t = self.RECORD.unpack(self._read(pos, self.RECORD.size))
+                body = self._read(pos + self.RECORD.size, size - self.RECORD.size)
+                out.append((body[:topic_len].decode(), body[topic_len:], t))
+                pos += size
+        return out
+
+    def commit(self, n):
+        ''' Remove the oldest n messages (after they were published) '''
+        with self._lock:
+            n = min(n, self.depth)
+            for i in range(n):
+                self._head += self.RECORD.unpack(self._read(self._head, self.RECORD.size))[0]
+            self.depth -= n
+            self.replayed += n
+            self._write_header()
+
+    def flush(self):
+        self._mm.flush()
+
+    def close(self):
+        self._mm.flush()
+        self._mm.close()
+        os.close(self._fd)
+
+class SpoolReplayer:
+    ''' Replays the spool after reconnect. Call step() from a scheduler task every period (sec).
+        Each step sends at most rate*period messages so live publishes scheduled between steps go out ahead of the backlog '''
+
+    def __init__(self, spool, client, rate=100, period=0.1, flow=None, qos=0):
+        self.spool = spool
+        self.client = client
+        self.flow = flow            # Optional FlowControl. Replay pauses while the publish window is full
+        self.qos = qos
+        self.rate = rate            # msgs/sec limit
+        self.period = period
+        self._t0 = None
+        self._sent = 0
+        self.throughput = 0.0       # msgs/sec over the current (or last) replay
+
+    def step(self):
+        if not self.spool.depth or not self.client.connected:
+            self._t0 = None
+            return 0
+        if self._t0 is None:
+            self._t0, self._sent = perf_counter(), 0
+        sent = 0
+        flow = self.flow
+        for topic, payload, t in self.spool.peek(max(1, int(self.rate * self.period))):
+            if flow is not None and flow.full:  # Broker is behind. Live data gets the window first
+                break
+            info = self.client.publish(topic, payload, qos=self.qos)
+            if info.rc != 0:                    # Lost connection mid replay. Leave the rest spooled
+                break
+            if flow is not None:
+                flow.sent(info.mid)
+            sent += 1
+        self.spool.commit(sent)
+        self._sent += sent
+        self.throughput = self._sent / max(perf_counter() - self._t0, self.period)
+        return sent
+
+    def stats(self):
+        return {'depth': self.spool.depth, 'bytes': self.spool.bytes, 'dropped': self.spool.dropped,
+                'replayed': self.spool.replayed, 'replay_msgs_per_sec': round(self.throughput, 1)}
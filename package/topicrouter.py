@@ -0,0 +1,90 @@
+class _Node:
+    __slots__ = ('children', 'plus', 'hash', 'handlers')
+
+    def __init__(self):
+        self.children = {}      # Literal topic level -> _Node
+        self.plus = None        # '+' single level wildcard child
+        self.hash = []          # Handlers registered with a trailing '#'
+        self.handlers = []      # Handlers for a topic ending at this node
+
+class TopicRouter:
+    ''' Trie of mqtt topic levels. Supports '+' (one level) and '#' (rest of topic) wildcards.
+        As in the MQTT spec a wildcard first level does not match topics starting with '$' (ie $SYS/...).
+        Handlers are called as handler(levels, payload) where levels is the list of topic levels '''
+
+    CACHE_SIZE = 4096
+
+    def __init__(self):
+        self._root = _Node()
+        self._cache = {}        # topic -> handlers. Topics repeat so dispatch is a dict lookup after first match
+
+    def add(self, pattern, handler):
+        ''' Register handler for a subscription pattern (ie nred2pi/servoZCMD/+) '''
+        node = self._root
+        levels = pattern.split('/')
+        for i, level in enumerate(levels):
+            if level == '#':
+                if i != len(levels) - 1:
+                    raise ValueError(f"'#' must be the last level in {pattern}")
+                node.hash.append(handler)
+                break
+            if level == '+':
+                if node.plus is None:
+                    node.plus = _Node()
+                node = node.plus
+            else:
+                node = node.children.setdefault(level, _Node())
+        else:
+            node.handlers.append(handler)
+        self._cache.clear()
+
+    def remove(self, pattern, handler):
+        node = self._root
+        levels = pattern.split('/')
+        for level in levels:
+            if level == '#':
+                node.hash.remove(handler)
+                break
+            node = node.plus if level == '+' else node.children.get(level)
+            if node is None:
+                raise KeyError(pattern)
+        else:
+            node.handlers.remove(handler)
+        self._cache.clear()
+
+    def match(self, topic):
+        ''' Return list of handlers matching topic '''
+        handlers = self._cache.get(topic)
+        if handlers is None:
+            handlers = []
+            levels = topic.split('/')
+            if topic[:1] == '$':        # $SYS/... Only literal first levels match
+                child = self._root.children.get(levels[0])
+                if child is not None:
+                    self._walk(child, levels, 1, handlers)
+            else:
+                self._walk(self._root, levels, 0, handlers)
+            if len(self._cache) >= self.CACHE_SIZE:
+                self._cache.clear()
+            self._cache[topic] = handlers
+        return handlers
+
+    def _walk(self, node, levels, i, out):
+        out.extend(node.hash)
+        if i == len(levels):
+            out.extend(node.handlers)
+            return
+        child = node.children.get(levels[i])
+        if child is not None:
+            self._walk(child, levels, i + 1, out)
+        if node.plus is not None:
+            self._walk(node.plus, levels, i + 1, out)
+
+    def dispatch(self, topic, payload):
+        ''' Call every handler matching topic. Returns number of handlers called '''
+        handlers = self.match(topic)
+        if handlers:
+            levels = topic.split('/')
+            for handler in handlers:
+                handler(levels, payload)
+        return len(handlers)
@@ -0,0 +1,37 @@
+''' BusReader deadline handling. Failed reads are reported apart from late ones '''
+import logging
+import time
+from package.busreader import BusReader
+
+def quiet():
+    logger = logging.getLogger('test.busreader')
+    logger.propagate = False
+    return logger
+
+def test_late_and_failed_are_separate():
+    reader = BusReader(max_workers=3, mlogger=quiet())
+    def fail():
+        raise OSError("i2c")
+    reader.add_device('ok', 'i2c1', lambda: {'V': 1})
+    reader.add_device('bad', 'i2c2', fail)
+    reader.add_device('slow', 'i2c3', lambda: time.sleep(0.3) or {'V': 2})
+    try:
+        results, late, failed = reader.read(['ok', 'bad', 'slow'], 0.05)
+    finally:
+        reader.shutdown()
+    assert results == {'ok': {'V': 1}}
+    assert late == ['slow'] and failed == ['bad']
+    assert reader.late == {'ok': 0, 'bad': 0, 'slow': 1}
+    assert reader.failed == {'ok': 0, 'bad': 1, 'slow': 0}
+
+def test_same_bus_devices_after_a_failure_are_read():
+    reader = BusReader(mlogger=quiet())
+    def fail():
+        raise OSError("i2c")
+    reader.add_device('bad', 'i2c1', fail)
+    reader.add_device('ok', 'i2c1', lambda: {'V': 1})
+    try:
+        results, late, failed = reader.read(['bad', 'ok'], 1.0)
+    finally:
+        reader.shutdown()
+    assert results == {'ok': {'V': 1}} and late == [] and failed == ['bad']
@@ -0,0 +1,65 @@
+''' CommandQueue coalescing, priority ordering and stop cancelling '''
+import threading
+from package.cmdqueue import CommandQueue
+
+def test_latest_wins():
+    handled = []
+    queue = CommandQueue(lambda topic, payload: handled.append((topic, payload)))
+    for position in range(5):
+        queue.put('nred2pi/servoZCMD/pos', position)
+    queue.put('nred2pi/stepperZCMD/pos', 9)
+    assert queue.depth == 2
+    assert queue.drain() == 2
+    assert handled == [('nred2pi/servoZCMD/pos', 4), ('nred2pi/stepperZCMD/pos', 9)]
+    assert queue.stats() == {'handled': 2, 'coalesced': 4, 'priority': 0, 'cancelled': 0, 'depth': 0}
+
+def test_stop_cancels_pending_for_its_lvl2():
+    handled = []
+    queue = CommandQueue(lambda topic, payload: handled.append(topic), priority=['nred2pi/+/stop'])
+    queue.put('nred2pi/servoZCMD/pos', 1)
+    queue.put('nred2pi/servoZCMD/speed', 2)
+    queue.put('nred2pi/stepperZCMD/pos', 3)
+    queue.put('nred2pi/servoZCMD/stop', b'')
+    queue.drain()
+    assert handled == ['nred2pi/servoZCMD/stop', 'nred2pi/stepperZCMD/pos']
+    assert queue.counters['cancelled'] == 2
+
+def test_priority_runs_next_and_put_does_not_block():
+    ''' A stop that arrives while a slow handler runs is handled right after it, ahead of queued commands '''
+    handled = []
+    running, release = threading.Event(), threading.Event()
+    def handler(topic, payload):
+        if topic.endswith('/slow'):
+            running.set()
+            release.wait(2)
+        handled.append(topic)
+    queue = CommandQueue(handler, priority=['n/+/stop'])
+    queue.start()
+    try:
+        queue.put('n/aZCMD/slow', 1)
+        assert running.wait(2)
+        queue.put('n/oZCMD/0', 1)
+        queue.put('n/sZCMD/stop', 1)        # Returns while the slow handler still holds the worker
+        assert handled == []
+        release.set()
+    finally:
+        queue.stop()
+    queue.drain()                           # Anything the worker left when stopped
+    assert handled == ['n/aZCMD/slow', 'n/sZCMD/stop', 'n/oZCMD/0']
+
+def test_handler_errors_are_logged():
+    def handler(topic, payload):
+        raise ValueError(payload)
+    queue = CommandQueue(handler)
+    queue.put('n/aZCMD/x', 'bad')
+    assert queue.drain() == 1 and queue.counters['handled'] == 1
+
+def test_notify_once_per_batch():
+    calls = []
+    queue = CommandQueue(lambda topic, payload: None, priority=['n/+/stop'], notify=calls.append)
+    queue.put('n/aZCMD/x', 1)
+    queue.put('n/aZCMD/y', 1)               # Drain already scheduled
+    assert len(calls) == 1
+    calls[0]()
+    queue.put('n/aZCMD/stop', 1)
+    assert len(calls) == 2
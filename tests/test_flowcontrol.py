@@ -0,0 +1,114 @@
+''' FlowControl window accounting, stretch factor and Publisher backpressure '''
+import json
+import logging
+from package.flowcontrol import FlowControl
+from package.publisher import Publisher
+from package.sim import SimBroker, SimClient
+from package.spool import Spool
+
+def quiet():
+    logger = logging.getLogger('test.flow')
+    logger.propagate = False
+    return logger
+
+def test_sent_then_acked():
+    flow = FlowControl(window=2, mlogger=quiet())
+    flow.sent(1)
+    flow.sent(2)
+    assert flow.inflight == 2 and flow.full
+    flow.acked(1)
+    assert flow.inflight == 1 and not flow.full
+    assert flow.stats()['acked'] == 1
+
+def test_ack_before_sent():
+    ''' paho can call on_publish before publish() returns the mid '''
+    flow = FlowControl(window=2, mlogger=quiet())
+    flow.acked(7)
+    assert flow.inflight == 0
+    flow.sent(7)                        # Already acked. Never counted in flight
+    assert flow.inflight == 0 and flow.counters == dict(flow.counters, sent=1, acked=1)
+    flow.sent(8)
+    assert flow.inflight == 1
+
+def test_early_acks_bounded():
+    flow = FlowControl(window=2, mlogger=quiet())
+    for mid in range(100):              # Untracked acks (ie schema announcements)
+        flow.acked(mid)
+    assert len(flow._early) <= flow.window * 4
+
+def test_clear():
+    flow = FlowControl(window=2, mlogger=quiet())
+    flow.sent(1)
+    flow.acked(5)
+    flow.clear()
+    assert flow.inflight == 0 and not flow._early
+
+def test_stretch_doubles_and_halves():
+    flow = FlowControl(window=8, high=0.75, low=0.25, max_stretch=4, mlogger=quiet())
+    for mid in range(7):                # 7 > 0.75 * 8 in flight
+        flow.sent(mid)
+    assert flow.update() == 2
+    assert flow.update() == 4           # Still congested
+    assert flow.update() is None        # Capped at max_stretch
+    for mid in range(6):
+        flow.acked(mid)                 # 1 in flight. Peak since the last update was still 7
+    assert flow.update() is None
+    assert flow.update() == 2           # Below low
+    assert flow.update() == 1
+    assert flow.update() is None
+
+def test_between_thresholds_holds():
+    flow = FlowControl(window=8, high=0.75, low=0.25, mlogger=quiet())
+    for mid in range(7):
+        flow.sent(mid)
+    flow.update()
+    for mid in range(3):
+        flow.acked(mid)                 # 4 in flight: between low (2) and high (6)
+    assert flow.update() == 4           # Peak since the last update was still 7
+    assert flow.update() is None and flow.stretch == 4
+
+def test_blocked_stretches():
+    flow = FlowControl(window=8, mlogger=quiet())
+    flow.block()
+    assert flow.update() == 2 and flow.stats()['blocked'] == 1
+
+def setup(flow, spool=None):
+    broker = SimBroker()
+    client = SimClient(broker=broker, ack_delay=60)     # Acks never arrive during the test
+    client.connect('sim')
+    client.connected = True
+    client.on_publish = lambda client, userdata, mid: flow.acked(mid)
+    publisher = Publisher(client=client, flow=flow, spool=spool)
+    publisher.add_device('a', 'pi2nred/a/pi', 'a', keys=('x',))
+    return publisher
+
+def test_publisher_holds_while_full():
+    flow = FlowControl(window=2, mlogger=quiet())
+    publisher = setup(flow)
+    assert [publisher.submit('a', {'x': x}) for x in (1, 2, 3)] == [True, True, False]
+    assert flow.inflight == 2 and flow.counters['blocked'] == 1
+    flow.acked(1)
+    assert publisher.submit('a', {'x': 3})      # Held data offered again once there is room
+
+def test_publisher_spools_while_full(tmp_path):
+    flow = FlowControl(window=1, mlogger=quiet())
+    spool = Spool(str(tmp_path / 'spool.dat'), max_bytes=4096)
+    publisher = setup(flow, spool)
+    publisher.submit('a', {'x': 1})
+    publisher.submit('a', {'x': 2})
+    assert flow.inflight == 1 and flow.counters['blocked'] == 1
+    assert [json.loads(payload) for topic, payload, t in spool.peek(5)] == [{'x': 2}]
+    spool.close()
+
+def test_batch_flush_holds_while_full():
+    flow = FlowControl(window=1, mlogger=quiet())
+    publisher = setup(flow)
+    publisher.batch = True
+    publisher.submit('a', {'x': 1})
+    publisher.flush()
+    publisher.submit('a', {'x': 2})
+    publisher.flush()                   # Full. Kept pending
+    assert flow.counters['sent'] == 1 and publisher._pending
+    flow.acked(1)
+    publisher.flush()
+    assert flow.counters['sent'] == 2 and not publisher._pending
@@ -0,0 +1,42 @@
+''' Histogram log-linear bucketing and percentiles '''
+from package.instrument import Histogram
+
+def test_small_values_exact():
+    hist = Histogram()
+    for value in range(Histogram.SUB):
+        assert hist._index(value) == value and hist._value(value) == value
+
+def test_bucket_bounds():
+    ''' Every value lands in a bucket whose lowest value is <= it and within the ~6% resolution. Buckets are monotonic '''
+    hist = Histogram()
+    previous = -1
+    for value in list(range(1, 5000)) + [10**k + d for k in range(4, 10) for d in (-1, 0, 1)]:
+        index = hist._index(value)
+        low = hist._value(index)
+        assert low <= value < low + max(1, low >> (Histogram.SUB_BITS - 1))
+        if value < 5000:
+            assert index >= previous
+            previous = index
+
+def test_clamped_to_max_value():
+    hist = Histogram(max_value=1000)
+    hist.record(10**9)
+    assert hist.counts[len(hist.counts) - 1] == 1
+    assert hist.percentile(100) == 10**9    # Overflow bucket reports the real max, not its lowest value
+
+def test_percentiles():
+    hist = Histogram()
+    for value in range(1, 1001):
+        hist.record(value * 1000)
+    for p, expected in ((50, 500_000), (90, 900_000), (99, 990_000)):
+        assert expected * 0.93 <= hist.percentile(p) <= expected
+    assert hist.count == 1000 and hist.min == 1000 and hist.max == 1_000_000
+    summary = hist.as_dict()
+    assert summary['min'] == 1.0 and summary['max'] == 1000.0 and summary['mean'] == 500.5
+
+def test_empty_and_reset():
+    hist = Histogram()
+    assert hist.percentile(99) == 0 and hist.as_dict() == {'count': 0}
+    hist.record(5)
+    hist.reset()
+    assert hist.count == 0 and sum(hist.counts) == 0 and hist.min is None
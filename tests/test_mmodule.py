@@ -0,0 +1,73 @@
+''' Mmodule.device burst path: fixed point scaling of SimINA219 raw registers and conversion ready polling '''
+import logging
+from package.Mmodule import device, CNVR, OVF
+from package.sim import SimINA219
+
+class Registers(SimINA219):
+    ''' SimINA219 returning set raw registers. polls = bus_register() values, then ready '''
+
+    def __init__(self, registers, polls=(), current_lsb_ua=20):
+        super().__init__()
+        self.raw = registers
+        self.polls = list(polls)
+        self.current_lsb_ua = current_lsb_ua
+
+    def registers(self):
+        self._transaction()
+        return self.raw
+
+    def bus_register(self):
+        self._transaction()
+        return self.polls.pop(0) if self.polls else self.raw[0] | CNVR
+
+def make(ina219, **kwargs):
+    logger = logging.getLogger('test.mmodule')
+    logger.propagate = False
+    return device('V', 'I', mlogger=logger, ina219=ina219, **kwargs)
+
+def bus(mv, flags=CNVR):
+    return (mv // 4) << 3 | flags
+
+def test_bus_voltage_lsb():
+    for mv in (0, 4, 3300, 5000, 32764):
+        assert make(Registers((bus(mv), 0, 0, 0))).read()['V'] == mv / 1000
+    assert make(Registers((bus(5003), 0, 0, 0))).read()['V'] == 5.0     # Below one 4 mV step
+
+def test_signed_current_rounding():
+    cases = [(20, 1, 0.02), (20, 0xFFFF, -0.02), (20, 12500, 250.0), (20, 0x8000, -655.36),
+             (7, 1, 0.01), (7, 0xFFFF, -0.01), (7, 0xFFFE, -0.01), (5, 1, 0.01), (5, 0xFFFF, 0.0), (3, 1, 0.0)]
+    for lsb_ua, raw, milliamps in cases:
+        assert make(Registers((bus(5000), 0, raw, 0), current_lsb_ua=lsb_ua)).read()['I'] == milliamps, (lsb_ua, raw)
+
+def test_matches_sim_registers():
+    ina219 = SimINA219(rate=1e6)
+    dev = make(ina219)
+    raw = ina219.registers()
+    volts, milliamps = dev._convert(raw)
+    assert volts == (raw[0] >> 3) * 4 / 1000
+    assert abs(milliamps - raw[2] * ina219.current_lsb_ua / 1000) <= 0.005
+    assert 4.9 < volts < 5.1 and 200 < milliamps < 300
+
+def test_overflow_keeps_voltage():
+    ina219 = Registers((bus(5000), 0, 12500, 0))
+    dev = make(ina219)
+    dev.read()
+    ina219.raw = (bus(4800, CNVR | OVF), 0, 99, 0)
+    data = dev.read()
+    assert data == {'V': 4.8, 'I': 250.0}      # V updated, I keeps the last good value
+
+def test_waits_for_conversion_ready():
+    ina219 = Registers((bus(5000, 0), 0, 0, 0), polls=[bus(5000, 0), bus(5000, 0)])
+    dev = make(ina219)
+    dev.read()
+    assert ina219.reads == 5 and dev.stale == 0     # burst, two polls not ready, ready poll, burst again
+
+def test_stale_when_not_ready():
+    ina219 = Registers((bus(5000, 0), 0, 0, 0), polls=[bus(5000, 0)] * 10**6)
+    dev = make(ina219, ready_timeout=0.001)
+    assert dev.read()['V'] == 5.0
+    assert dev.stale == 1
+    ina219.raw = (bus(5000), 0, 0, 0)       # Ready: no polling
+    reads = ina219.reads
+    dev.read()
+    assert dev.stale == 1 and ina219.reads == reads + 1
@@ -0,0 +1,98 @@
+''' Publisher deadband/heartbeat, per topic batching and spool vs live routing against SimBroker/SimClient '''
+import json
+from package.publisher import Publisher
+from package.sim import SimBroker, SimClient
+from package.spool import Spool
+
+class Recorder:
+    ''' Broker subscriber that keeps (topic, decoded payload) '''
+
+    def __init__(self, broker, pattern='pi2nred/#'):
+        self.messages = []
+        broker.subscribe(self, pattern)
+
+    def _deliver(self, levels, msg):
+        self.messages.append((msg.topic, json.loads(msg.payload)))
+
+def setup(spool=None, batch=False, flow=None):
+    broker = SimBroker()
+    recorder = Recorder(broker)
+    client = SimClient(broker=broker)
+    client.connect('sim')
+    client.connected = True     # demo_main_script sets this flag in on_connect
+    return Publisher(client=client, batch=batch, spool=spool, flow=flow), client, recorder
+
+def test_absolute_deadband():
+    publisher, client, recorder = setup()
+    publisher.add_device('ina', 'pi2nred/ina/pi', 'ina', keys=('V',), deadband={'V': 0.05})
+    sent = [publisher.submit('ina', {'V': v}) for v in (5.0, 5.03, 5.05, 5.06, 5.02)]
+    assert sent == [True, False, False, True, False]    # Compared with the last published value, not the last offer
+    assert [data['V'] for topic, data in recorder.messages] == [5.0, 5.06]
+    assert publisher.stats()['suppressed'] == 3
+
+def test_percent_deadband():
+    publisher, client, recorder = setup()
+    publisher.add_device('ina', 'pi2nred/ina/pi', 'ina', keys=('I',), deadband={'I': '2%'})
+    assert [publisher.submit('ina', {'I': i}) for i in (100, 101.9, 98.1, 102.1, 104.0)] == [True, False, False, True, False]
+
+def test_percent_deadband_from_zero():
+    ''' Any change from 0 publishes (2% of 0 is 0). No change is still suppressed '''
+    publisher, client, recorder = setup()
+    publisher.add_device('ina', 'pi2nred/ina/pi', 'ina', keys=('I',), deadband={'I': '2%'})
+    assert [publisher.submit('ina', {'I': i}) for i in (0, 0, 0.001, 0.001)] == [True, False, True, False]
+
+def test_keys_without_deadband_and_non_numeric():
+    publisher, client, recorder = setup()
+    publisher.add_device('sw', 'pi2nred/sw/pi', 'sw', keys=('V', 'state'), deadband={'V': 1})
+    assert [publisher.submit('sw', data) for data in ({'V': 1, 'state': 'on'}, {'V': 1.5, 'state': 'on'},
+                                                      {'V': 1.5, 'state': 'off'}, {'V': 1.5, 'state': None})] == [True, False, True, True]
+
+def test_heartbeat():
+    publisher, client, recorder = setup()
+    publisher.add_device('a', 'pi2nred/a/pi', 'a', keys=('x',), heartbeat=3)
+    publisher.add_device('b', 'pi2nred/b/pi', 'b', keys=('x',), heartbeat=0)
+    assert [publisher.submit('a', {'x': 1}) for i in range(7)] == [True, False, False, True, False, False, True]
+    assert [publisher.submit('b', {'x': 1}) for i in range(5)] == [True, False, False, False, False]
+
+def test_device_dict_is_copied():
+    publisher, client, recorder = setup()
+    publisher.add_device('a', 'pi2nred/a/pi', 'a', keys=('x',))
+    outgoing = {'x': 1}
+    publisher.submit('a', outgoing)
+    outgoing['x'] = 2                   # Drivers reuse their outgoing dict
+    assert publisher.submit('a', outgoing)
+
+def test_batch_per_topic():
+    publisher, client, recorder = setup(batch=True)
+    publisher.add_device('a', 'pi2nred/ina/piA', 'ina', keys=('x',))
+    publisher.add_device('b', 'pi2nred/ina/piB', 'ina', keys=('y',))
+    publisher.add_device('c', 'pi2nred/ina/piA', 'ina', keys=('z',))
+    for device, key in (('a', 'x'), ('b', 'y'), ('c', 'z')):
+        publisher.submit(device, {key: 1})
+    assert recorder.messages == []      # Nothing until flush
+    publisher.flush()
+    assert sorted(recorder.messages) == [('pi2nred/ina/piA', {'x': 1, 'z': 1}), ('pi2nred/ina/piB', {'y': 1})]
+    publisher.flush()
+    assert len(recorder.messages) == 2
+
+def test_spool_while_disconnected(tmp_path):
+    spool = Spool(str(tmp_path / 'spool.dat'), max_bytes=4096)
+    publisher, client, recorder = setup(spool=spool)
+    publisher.add_device('a', 'pi2nred/a/pi', 'a', keys=('x',))
+    publisher.submit('a', {'x': 1})
+    client.connected = False
+    publisher.submit('a', {'x': 2})
+    client.connected = True             # Flag still set but the socket is gone: publish rc != 0 goes to the spool too
+    client.disconnect()
+    publisher.submit('a', {'x': 3})
+    assert recorder.messages == [('pi2nred/a/pi', {'x': 1})]
+    assert [(topic, json.loads(payload)) for topic, payload, t in spool.peek(5)] == [('pi2nred/a/pi', {'x': 2}), ('pi2nred/a/pi', {'x': 3})]
+    assert publisher.stats()['spooled'] == 2 and publisher.stats()['sent'] == 1
+    spool.close()
+
+def test_announce_schema():
+    publisher, client, recorder = setup()
+    recorder_schema = Recorder(client.broker, 'schema/#')
+    publisher.add_device('a', 'pi2nred/a/pi', 'a', keys=('x', 'y'), schema_topic='schema/a/pi')
+    publisher.announce()
+    assert recorder_schema.messages == [('schema/a/pi', {'codec': 'json', 'keys': ['x', 'y'], 'format': None})]
@@ -0,0 +1,52 @@
+''' DeviceRegistry specs -> driver instances, read against the simulated INA219 '''
+import time
+import pytest
+from package.registry import DeviceRegistry
+
+def spec(**fields):
+    return dict({'name': 'pwr', 'driver': 'mmodule', 'lvl2': 'ina219B', 'data_keys': ['Vbusf', 'IbusAf'], 'interval': 1,
+                 'kwargs': {'address': 65}}, **fields)
+
+def test_required_fields_and_unique_names():
+    with pytest.raises(ValueError):
+        DeviceRegistry([{'name': 'a', 'driver': 'mmodule'}])
+    with pytest.raises(ValueError):
+        DeviceRegistry([spec(), spec()])
+
+def test_mmodule_read():
+    registry = DeviceRegistry([spec()], simulate=True)
+    device = registry.create(registry.devices[0])
+    data = getattr(device, registry.devices[0]['read'])()
+    assert set(data) == {'Vbusf', 'IbusAf'}
+    assert 4.9 < data['Vbusf'] < 5.1 and 200 < data['IbusAf'] < 300
+    assert device.burst and device.address == 65
+
+def test_mmodule_sampling():
+    registry = DeviceRegistry([spec(sampling={'rate': 1000, 'window': 0.1})], simulate=True)
+    s = registry.devices[0]
+    assert s['read'] == 'aggregate' and s['driver_keys'] == ['Vbusf', 'IbusAf']
+    assert s['data_keys'] == ['Vbusf_min', 'Vbusf_max', 'Vbusf_mean', 'Vbusf_rms',
+                              'IbusAf_min', 'IbusAf_max', 'IbusAf_mean', 'IbusAf_rms', 'EJf']
+    assert DeviceRegistry([s]).devices[0]['data_keys'] == s['data_keys']    # Shard workers get normalized specs
+    device = registry.create(s)
+    try:
+        time.sleep(0.05)
+        data = getattr(device, s['read'])()
+        assert list(data) == s['data_keys']
+        assert data['Vbusf_min'] <= data['Vbusf_mean'] <= data['Vbusf_max'] and data['EJf'] > 0
+    finally:
+        device.stop_sampling()
+
+def test_sampling_needs_mmodule():
+    with pytest.raises(ValueError):
+        DeviceRegistry([spec(driver='piina219', sampling={'rate': 1000})])
+
+def test_logger_argument():
+    calls = []
+    def driver(*args, **kwargs):
+        calls.append((args, kwargs))
+    registry = DeviceRegistry([spec(name='enc', driver='rotaryencoder', pins=[17, 27], kwargs={}), spec(driver='piina219', kwargs={})])
+    registry._drivers = {'rotaryencoder': driver, 'piina219': driver}
+    for s in registry.devices:
+        registry.create(s, 'log')
+    assert calls == [((17, 27, 'Vbusf', 'IbusAf', 'log'), {}), (('Vbusf', 'IbusAf'), {'mlogger': 'log'})]
@@ -0,0 +1,98 @@
+''' Scheduler timer heap with a fake clock: deadlines, missed periods, interval changes, edge callbacks '''
+import logging
+import pytest
+import package.scheduler as scheduler_module
+from package.scheduler import Scheduler
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(scheduler_module, 'perf_counter', clock)
+    return clock
+
+def quiet():
+    logger = logging.getLogger('test.scheduler')
+    logger.propagate = False
+    return logger
+
+def test_runs_when_due(clock):
+    scheduler, runs = Scheduler(mlogger=quiet()), []
+    scheduler.add_task('a', 0.5, lambda: runs.append('a'))
+    scheduler.add_task('b', 0.5, lambda: runs.append('b'), start_delay=0)
+    assert scheduler.run_due() == 0.5 and runs == ['b']
+    clock.now += 0.5
+    assert scheduler.run_due() == 0.5 and runs == ['b', 'a', 'b']     # Equal deadlines run in push order
+    assert scheduler.stats()['a']['runs'] == 1
+
+def test_read_callback(clock):
+    scheduler, got = Scheduler(mlogger=quiet()), []
+    scheduler.add_task('a', 1.0, got.append, start_delay=0, read=lambda: {'x': 1})
+    scheduler.run_due()
+    assert got == [{'x': 1}]
+
+def test_missed_periods_are_skipped(clock):
+    scheduler, runs = Scheduler(mlogger=quiet()), []
+    scheduler.add_task('a', 1.0, lambda: runs.append(clock.now))
+    clock.now += 4.5                    # Due at 101. Periods 102, 103, 104 were missed
+    assert scheduler.run_due() == pytest.approx(0.5)     # One run, next on the original grid (105)
+    assert runs == [104.5]
+    stats = scheduler.stats()['a']
+    assert stats['missed'] == 3 and stats['jitter_max_ms'] == pytest.approx(3500)
+
+def test_set_interval_and_remove_leave_stale_entries(clock):
+    scheduler, runs = Scheduler(mlogger=quiet()), []
+    scheduler.add_task('a', 1.0, lambda: runs.append('a'))
+    scheduler.set_interval('a', 3.0)    # Old heap entry for 101 is stale
+    assert scheduler.get_interval('a') == 3.0
+    clock.now += 1.0
+    assert scheduler.run_due() == pytest.approx(2.0) and runs == []
+    clock.now += 2.0
+    scheduler.run_due()
+    assert runs == ['a']
+    scheduler.remove_task('a')
+    clock.now += 3.0
+    assert scheduler.run_due() is None and runs == ['a']
+
+def test_call_soon_edges(clock):
+    scheduler, runs = Scheduler(mlogger=quiet()), []
+    scheduler.call_soon('enc', lambda: runs.append(1))
+    scheduler.call_soon('enc', lambda data: runs.append(data), read=lambda: 2)
+    clock.now += 0.002
+    assert scheduler.run_pending() == 2 and runs == [1, 2]
+    stats = scheduler.stats()['enc']
+    assert stats['edges'] == 2 and stats['runs'] == 0 and stats['jitter_max_ms'] == pytest.approx(2)
+    assert scheduler.run_due() is None  # Edge only device has no timer
+
+def test_failing_callbacks_do_not_stop_the_loop(clock):
+    scheduler, runs = Scheduler(mlogger=quiet()), []
+    def fail():
+        raise OSError("i2c")
+    scheduler.add_task('bad', 1.0, fail, start_delay=0)
+    scheduler.add_task('good', 1.0, lambda: runs.append('timer'), start_delay=0)
+    scheduler.call_soon('edge', fail)
+    scheduler.call_soon('edge', lambda: runs.append('edge'))
+    scheduler.run_pending()
+    scheduler.run_due()
+    assert runs == ['edge', 'timer']
+
+def test_invalid_interval():
+    with pytest.raises(ValueError):
+        Scheduler(mlogger=quiet()).add_task('a', 0, lambda: None)
+
+def test_run_and_stop():
+    scheduler = Scheduler(mlogger=quiet())
+    runs = []
+    def tick():
+        runs.append(1)
+        if len(runs) == 3:
+            scheduler.stop()
+    scheduler.add_task('a', 0.001, tick)
+    scheduler.run()
+    assert len(runs) == 3
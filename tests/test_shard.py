@@ -0,0 +1,64 @@
+''' SharedTable layout and seqlock '''
+import math
+import multiprocessing as mp
+from package.shard import SharedTable, _VERSION
+
+def test_write_read_roundtrip():
+    table = SharedTable({'a': ('x', 'y'), 'b': ('z',)})
+    try:
+        assert table.read('a')[0] == 0          # Never written
+        table.write('a', {'x': 1.5, 'y': 2})
+        table.write('b', {'z': -3})
+        version, stamp, values = table.read('a')
+        assert version == 2 and stamp > 0 and values == (1.5, 2.0)
+        assert table.read('b')[2] == (-3.0,)
+        table.write('a', {'x': 'on'})           # Non numeric and missing are NaN
+        version, stamp, values = table.read('a')
+        assert version == 4 and all(math.isnan(value) for value in values)
+    finally:
+        table.close()
+
+def test_interval():
+    table = SharedTable({'a': ('x',)})
+    try:
+        table.set_interval('a', 0.25)
+        table.write('a', {'x': 1})              # Does not touch the interval
+        assert table.get_interval('a') == 0.25
+    finally:
+        table.close()
+
+def test_attach_and_writer_restart():
+    table = SharedTable({'a': ('x',)})
+    try:
+        _VERSION.pack_into(table._buf, table.offsets['a'], 7)   # A writer crashed mid write
+        assert table.read('a', retries=10) is None
+        worker = SharedTable(table.layout, name=table.name)
+        worker.write('a', {'x': 4})             # Restarted writer continues past the open write
+        assert table.read('a')[0] == 10 and table.read('a')[2] == (4.0,)
+        worker.close()
+    finally:
+        table.close()
+
+def _writer(name, layout, count):
+    table = SharedTable(layout, name=name)
+    for i in range(count):
+        table.write('a', {'x': i, 'y': -i, 'z': i * 2})
+    table.close()
+
+def test_concurrent_reads_are_consistent():
+    table = SharedTable({'a': ('x', 'y', 'z')})
+    try:
+        proc = mp.get_context('spawn').Process(target=_writer, args=(table.name, table.layout, 200_000))
+        proc.start()
+        reads = 0
+        while proc.is_alive() or not reads:
+            reading = table.read('a')
+            if reading is not None and reading[0]:
+                x, y, z = reading[2]
+                assert y == -x and z == 2 * x
+                reads += 1
+        proc.join()
+        assert proc.exitcode == 0 and reads
+        assert table.read('a')[2] == (199_999.0, -199_999.0, 399_998.0)
+    finally:
+        table.close()
@@ -0,0 +1,72 @@
+''' Spool ring file: wraparound, drop oldest when full, reopen after restart, peek/commit replay.
+    Run from repo root: python3 -m pytest tests '''
+from package.spool import Spool
+
+RECORD = Spool.RECORD.size
+
+def make(tmp_path, capacity=200):
+    return Spool(str(tmp_path / 'spool.dat'), max_bytes=Spool.HEADER_SIZE + capacity)
+
+def test_peek_commit(tmp_path):
+    spool = make(tmp_path)
+    for i in range(3):
+        spool.append('t/a', f"m{i}")
+    assert [(topic, payload) for topic, payload, t in spool.peek(2)] == [('t/a', b'm0'), ('t/a', b'm1')]
+    assert spool.depth == 3             # peek does not remove
+    spool.commit(2)
+    assert spool.depth == 1 and spool.replayed == 2
+    assert spool.peek(5)[0][1] == b'm2'
+    spool.commit(5)                     # More than pending
+    assert spool.depth == 0 and spool.bytes == 0 and spool.peek(1) == []
+    spool.close()
+
+def test_full_drops_oldest_and_wraps(tmp_path):
+    spool = make(tmp_path)
+    size = RECORD + len('t') + 10
+    fits = spool.capacity // size
+    for i in range(fits + 3):           # Last records wrap around the end of the ring
+        spool.append(b't', f"{i:010d}")
+    assert spool.dropped == 3
+    assert spool.depth == fits
+    assert spool.bytes <= spool.capacity
+    assert [int(payload) for topic, payload, t in spool.peek(fits)] == list(range(3, fits + 3))
+    spool.close()
+
+def test_record_split_by_wrap(tmp_path):
+    spool = make(tmp_path, capacity=100)
+    spool.append('t', b'x' * 25)
+    spool.append('t', b'y' * 25)
+    spool.commit(1)
+    spool.append('t', b'z' * 25)        # Starts near the end of the ring and continues at the start
+    assert spool.dropped == 0
+    assert [payload for topic, payload, t in spool.peek(2)] == [b'y' * 25, b'z' * 25]
+    spool.close()
+
+def test_reopen_keeps_pending(tmp_path):
+    spool = make(tmp_path)
+    for i in range(4):
+        spool.append('t/b', f"m{i}")
+    spool.commit(1)
+    spool.close()
+    spool = make(tmp_path)
+    assert spool.depth == 3
+    assert [payload for topic, payload, t in spool.peek(3)] == [b'm1', b'm2', b'm3']
+    spool.close()
+
+def test_reopen_other_size_starts_empty(tmp_path):
+    spool = make(tmp_path)
+    spool.append('t', 'm')
+    spool.close()
+    spool = make(tmp_path, capacity=300)
+    assert spool.depth == 0
+    spool.close()
+
+def test_too_large(tmp_path):
+    spool = make(tmp_path, capacity=50)
+    try:
+        spool.append('t', b'x' * 50)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("expected ValueError")
+    spool.close()
@@ -0,0 +1,52 @@
+''' TopicRouter wildcard rules (MQTT 3.1.1 section 4.7) '''
+import pytest
+from package.topicrouter import TopicRouter
+
+def matches(patterns, topic):
+    router = TopicRouter()
+    for pattern in patterns:
+        router.add(pattern, pattern)
+    return sorted(router.match(topic))
+
+def test_literal():
+    assert matches(['a/b', 'a/c'], 'a/b') == ['a/b']
+    assert matches(['a/b'], 'a/b/c') == []
+    assert matches(['a/b/c'], 'a/b') == []
+
+def test_plus_is_one_level():
+    assert matches(['a/+/c'], 'a/b/c') == ['a/+/c']
+    assert matches(['a/+'], 'a/b/c') == []
+    assert matches(['a/+'], 'a/') == ['a/+']     # Empty level is still a level
+    assert matches(['+/+'], '/b') == ['+/+']
+
+def test_hash_is_rest_of_topic():
+    assert matches(['a/#'], 'a/b/c') == ['a/#']
+    assert matches(['a/#'], 'a') == ['a/#']      # Also the parent level
+    assert matches(['#'], 'a/b') == ['#']
+    assert matches(['a/#'], 'b/c') == []
+
+def test_all_matching_handlers():
+    assert matches(['a/b', 'a/+', 'a/#', '+/b', '#', 'x/#'], 'a/b') == ['#', '+/b', 'a/#', 'a/+', 'a/b']
+
+def test_dollar_topics_need_literal_first_level():
+    assert matches(['#', '+/monitor/Clients'], '$SYS/monitor/Clients') == []
+    assert matches(['$SYS/#', '$SYS/+/Clients'], '$SYS/monitor/Clients') == ['$SYS/#', '$SYS/+/Clients']
+    assert matches(['a/#'], 'a/$b') == ['a/#']   # Only the first level is special
+
+def test_hash_must_be_last():
+    with pytest.raises(ValueError):
+        TopicRouter().add('a/#/b', None)
+
+def test_remove_and_cache():
+    router = TopicRouter()
+    router.add('a/+', 'h')
+    assert router.match('a/b') == ['h']
+    router.remove('a/+', 'h')
+    assert router.match('a/b') == []
+
+def test_dispatch_levels():
+    calls = []
+    router = TopicRouter()
+    router.add('nred2pi/+/stop', lambda levels, payload: calls.append((levels, payload)))
+    assert router.dispatch('nred2pi/servoZCMD/stop', b'1') == 1
+    assert calls == [(['nred2pi', 'servoZCMD', 'stop'], b'1')]